@@ -10,7 +10,7 @@ import torch.optim.lr_scheduler as lr_scheduler
 import os
 import logging
 import time as Time
-from utility import pad_history,calculate_hit,extract_axis_1
+from utility import pad_history,calculate_hit,calculate_hit_tensor,extract_axis_1,weights_version,compiled_sample,multi_sample_scores,ItemMatrix,ItemIndex,autocast,load_data,TensorBatcher,Prefetcher
 from collections import Counter
 from Modules_ori import *
 
@@ -59,6 +59,48 @@ def parse_args():
                         help='')
     parser.add_argument('--descri', type=str, default='',
                         help='description of the work.')
+    parser.add_argument('--pin_memory', action='store_true', default=False,
+                        help='gather training batches into pinned memory.')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='batches prepared ahead by a background thread, 0 disables prefetching.')
+    parser.add_argument('--sampler', type=str, default='ddpm', choices=['ddpm', 'ddim'],
+                        help='reverse process used at prediction time.')
+    parser.add_argument('--sample_steps', type=int, default=0,
+                        help='timesteps visited by the ddim sampler, 0 uses all of them.')
+    parser.add_argument('--eta', type=float, default=0.0,
+                        help='noise scale of the ddim sampler, 0 is deterministic.')
+    parser.add_argument('--compile_sampler', action='store_true', default=False,
+                        help='trace the reverse loop once per batch shape and replay it (CUDA graph or torch.compile).')
+    parser.add_argument('--patience', type=int, default=0,
+                        help='stop sampling a row once its top patience_k items were stable for this many steps, 0 disables.')
+    parser.add_argument('--patience_k', type=int, default=10,
+                        help='size of the ranking checked by --patience.')
+    parser.add_argument('--tolerance', type=float, default=float('inf'),
+                        help='largest relative change of the predicted x_0 still counted as stable by --patience.')
+    parser.add_argument('--num_samples', type=int, default=1,
+                        help='reverse chains drawn per user at prediction time.')
+    parser.add_argument('--aggregate', type=str, default='mean', choices=['mean', 'rank'],
+                        help='how the scores of --num_samples chains are combined: mean or reciprocal rank fusion.')
+    parser.add_argument('--sample_chunk', type=int, default=4,
+                        help='chains per user drawn in one batch, bounds the memory of --num_samples.')
+    parser.add_argument('--item_index', type=str, default='none', choices=['none', 'exact', 'ivf'],
+                        help='search the top-k items of generated embeddings in an ItemIndex instead of scoring every item.')
+    parser.add_argument('--item_dtype', type=str, default='fp32', choices=['fp32', 'fp16', 'int8'],
+                        help='storage of the cached item matrix used for scoring.')
+    parser.add_argument('--nlist', type=int, default=0,
+                        help='clusters of the ivf item index, 0 uses sqrt(items).')
+    parser.add_argument('--nprobe', type=int, default=8,
+                        help='clusters searched per query by the ivf item index.')
+    parser.add_argument('--bench_sampler', type=str, default='',
+                        help='comma separated ddim lengths, e.g. 10,20,50: compare them with ddpm on the test data and exit.')
+    parser.add_argument('--bench_samples', type=str, default='',
+                        help='comma separated chains per user, e.g. 1,4,16: compare them on the test data and exit.')
+    parser.add_argument('--checkpoint', type=int, default=-1,
+                        help='epoch of ./models/tencVG{epoch}.pth and diffVG{epoch}.pth used by --bench_sampler and --bench_samples.')
+    parser.add_argument('--attention', type=str, default='math', choices=['math', 'sdpa'],
+                        help='MultiHeadAttention backend: explicit masks and softmax, or F.scaled_dot_product_attention.')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='autocast precision of training, p_losses and the sampler; fp16 trains with loss scaling.')
     return parser.parse_args()
 
 args = parse_args()
@@ -74,9 +116,10 @@ setup_seed(args.random_seed)
 
 
 def extract(a, t, x_shape):
+    # a is kept on the device of t (see diffusion.to), .to() is then a no-op and nothing syncs with the host
     batch_size = t.shape[0]
-    out = a.gather(-1, t.cpu())
-    return out.reshape(batch_size, *((1,) * (len(x_shape) - 1))).to(t.device)
+    out = a.to(t.device).gather(-1, t)
+    return out.reshape(batch_size, *((1,) * (len(x_shape) - 1)))
 
 def linear_beta_schedule(timesteps, beta_start, beta_end):
     beta_start = beta_start
@@ -115,6 +158,16 @@ def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     return np.array(betas)
 
 class diffusion():
+    # reverse process used by sample, see set_sampler
+    sampler = 'ddpm'
+    sample_steps = 0
+    eta = 0.0
+    compiled = False
+    patience = 0
+    patience_k = 10
+    tolerance = float('inf')
+    last_sample_steps = None
+
     def __init__(self, timesteps, beta_start, beta_end, w):
         self.timesteps = timesteps
         self.beta_start = beta_start
@@ -149,6 +202,13 @@ class diffusion():
 
         # calculations for posterior q(x_{t-1} | x_t, x_0)
         self.posterior_variance = self.betas * (1. - self.alphas_cumprod_prev) / (1. - self.alphas_cumprod)
+
+    def to(self, device):
+        # move the schedule buffers next to the model
+        for name, value in vars(self).items():
+            if torch.is_tensor(value):
+                setattr(self, name, value.to(device))
+        return self
     
     def q_sample(self, x_start, t, noise=None):
         # print(self.betas)
@@ -192,10 +252,15 @@ class diffusion():
             extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
         )
     
-    @torch.no_grad()
-    def p_sample(self, model_forward, model_forward_uncon, x, h, t, t_index):
-
-        x_start = (1 + self.w) * model_forward(x, h, t) - self.w * model_forward_uncon(x, t)
+    def guided_start(self, model_forward, model_forward_uncon, x, h, t, *cond):
+        # classifier-free guidance, model_forward_uncon=None means model_forward(x, h, t, *cond, w)
+        # returns the guided x_0 itself from one fused conditional + unconditional batch
+        if model_forward_uncon is None:
+            return model_forward(x, h, t, *cond, self.w)
+        return (1 + self.w) * model_forward(x, h, t, *cond) - self.w * model_forward_uncon(x, t, *cond)
+
+    def posterior_sample(self, x_start, x, t, t_index, noise=None):
+        # x_{t-1} drawn from q(x_{t-1} | x_t, x_0) with the predicted x_0, its mean at t_index 0
         x_t = x 
         model_mean = (
             extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
@@ -206,15 +271,128 @@ class diffusion():
             return model_mean
         else:
             posterior_variance_t = extract(self.posterior_variance, t, x.shape)
-            noise = torch.randn_like(x)
+            if noise is None:
+                noise = torch.randn_like(x)
 
             return model_mean + torch.sqrt(posterior_variance_t) * noise 
+
+    @torch.no_grad()
+    def p_sample(self, model_forward, model_forward_uncon, x, h, t, t_index, noise=None):
+
+        x_start = self.guided_start(model_forward, model_forward_uncon, x, h, t)
+        return self.posterior_sample(x_start, x, t, t_index, noise)
         
+    def set_sampler(self, sampler='ddpm', sample_steps=0, eta=0.0, compiled=False, patience=0, patience_k=10, tolerance=float('inf')):
+        """
+        Select the reverse process used by sample.
+        :param sampler: 'ddpm' walks every timestep, 'ddim' a strided subsequence of them.
+        :param sample_steps: length of the ddim subsequence, 0 uses every timestep.
+        :param eta: ddim noise scale, 0 is deterministic and 1 matches the ddpm posterior variance.
+        :param compiled: trace the reverse loop once per batch shape and replay it, see utility.CompiledSampler.
+        :param patience: retire a row after its top patience_k items were stable for this many steps,
+                         see adaptive_sample; 0 runs every row through the whole chain.
+        :param patience_k: size of the ranking checked for stability.
+        :param tolerance: largest relative change of the predicted x_0 still counted as stable.
+        """
+        if sampler not in ('ddpm', 'ddim'):
+            raise ValueError('unknown sampler: {}'.format(sampler))
+        self.sampler = sampler
+        self.sample_steps = sample_steps
+        self.eta = eta
+        self.compiled = compiled
+        self.patience = patience
+        self.patience_k = patience_k
+        self.tolerance = tolerance
+
+    def ddim_timesteps(self):
+        # evenly spaced subsequence of [timesteps - 1, ..., 0], descending
+        steps = min(self.sample_steps or self.timesteps, self.timesteps)
+        return torch.linspace(self.timesteps - 1, 0, steps).round().long().unique_consecutive().tolist()
+
+    def ddim_step(self, x, x_start, alpha_cumprod, alpha_cumprod_prev, noise=None):
+        # x at the previous ddim timestep from x and the predicted x_0, alpha_cumprod_prev = 1 returns x_0
+        predicted_noise = (x - math.sqrt(alpha_cumprod) * x_start) / math.sqrt(1. - alpha_cumprod)
+        sigma = self.eta * math.sqrt((1. - alpha_cumprod_prev) / (1. - alpha_cumprod) * (1. - alpha_cumprod / alpha_cumprod_prev))
+        x_prev = math.sqrt(alpha_cumprod_prev) * x_start + math.sqrt(max(1. - alpha_cumprod_prev - sigma ** 2, 0.)) * predicted_noise
+        if sigma > 0:
+            if noise is None:
+                noise = torch.randn_like(x)
+            x_prev = x_prev + sigma * noise
+        return x_prev
+
+    @torch.no_grad()
+    def p_sample_ddim(self, model_forward, model_forward_uncon, x, h, t, alpha_cumprod, alpha_cumprod_prev, noise=None):
+        x_start = self.guided_start(model_forward, model_forward_uncon, x, h, t)
+        return self.ddim_step(x, x_start, alpha_cumprod, alpha_cumprod_prev, noise)
+
     @torch.no_grad()
-    def sample(self, model_forward, model_forward_uncon, h):
+    def adaptive_sample(self, model_forward, model_forward_uncon, h, item_topk, *cond):
+        """
+        Reverse loop that retires a row once the top patience_k items of its predicted x_0, scored by
+        item_topk (x_0, k -> scores, ids), kept the same ranking for patience steps, with x_0 moving by at most tolerance
+        (relative norm) per step; a retired row returns that x_0 and is dropped from the batch.
+        last_sample_steps holds the reverse steps every row took.
+        """
+        if self.sampler == 'ddim':
+            timesteps = self.ddim_timesteps()
+            alphas_cumprod = self.alphas_cumprod.tolist() + [1.0]
+        else:
+            timesteps = list(reversed(range(0, self.timesteps)))
+        batch_size = h.shape[0]
+        output = torch.empty_like(h)
+        steps = torch.full((batch_size, ), len(timesteps), dtype=torch.long, device=h.device)
+        active = torch.arange(batch_size, device=h.device)
+        stable = torch.zeros(batch_size, dtype=torch.long, device=h.device)
+        previous_start, previous_topk = None, None
+        x = torch.randn_like(h)
+
+        for i, (n, n_prev) in enumerate(zip(timesteps, timesteps[1:] + [-1])):
+            t = torch.full((x.shape[0], ), n, device=h.device, dtype=torch.long)
+            x_start = self.guided_start(model_forward, model_forward_uncon, x, h, t, *cond)
+            if self.sampler == 'ddim':
+                x = self.ddim_step(x, x_start, alphas_cumprod[n], alphas_cumprod[n_prev])
+            else:
+                x = self.posterior_sample(x_start, x, t, n)
+
+            _, topk = item_topk(x_start, self.patience_k)
+            if previous_topk is not None:
+                change = (x_start - previous_start).norm(dim=1) / previous_start.norm(dim=1).clamp_min(1e-12)
+                same = torch.eq(topk, previous_topk).all(dim=1) & (change <= self.tolerance)
+                stable = torch.where(same, stable + 1, torch.zeros_like(stable))
+            done = stable >= self.patience
+            if i + 1 < len(timesteps) and done.any():
+                output[active[done]] = x_start[done]
+                steps[active[done]] = i + 1
+                keep = ~done
+                active, x, h, x_start, topk, stable = active[keep], x[keep], h[keep], x_start[keep], topk[keep], stable[keep]
+                cond = [c[keep] for c in cond]
+                if len(active) == 0:
+                    break
+            previous_start, previous_topk = x_start, topk
+
+        output[active] = x
+        self.last_sample_steps = steps
+        return output
+
+    @torch.no_grad()
+    def sample(self, model_forward, model_forward_uncon, h, item_topk=None):
+        # item_topk, the top-k item search of samples (ItemMatrix.topk, ItemIndex.search), enables early exit when patience > 0
+        if self.patience > 0 and item_topk is not None:
+            return self.adaptive_sample(model_forward, model_forward_uncon, h, item_topk)
+        if self.compiled:
+            return compiled_sample(self, model_forward, model_forward_uncon, h)
+
         x = torch.randn_like(h)
         # x = torch.randn_like(h) / 100
 
+        if self.sampler == 'ddim':
+            timesteps = self.ddim_timesteps()
+            # host copy read once per call, index -1 (after the last step) is alpha_cumprod = 1
+            alphas_cumprod = self.alphas_cumprod.tolist() + [1.0]
+            for n, n_prev in zip(timesteps, timesteps[1:] + [-1]):
+                x = self.p_sample_ddim(model_forward, model_forward_uncon, x, h, torch.full((h.shape[0], ), n, device=device, dtype=torch.long), alphas_cumprod[n], alphas_cumprod[n_prev])
+            return x
+
         for n in reversed(range(0, self.timesteps)):
             x = self.p_sample(model_forward, model_forward_uncon, x, h, torch.full((h.shape[0], ), n, device=device, dtype=torch.long), n)
 
@@ -238,7 +416,11 @@ class SinusoidalPositionEmbeddings(nn.Module):
     
         
 class Tenc(nn.Module):
-    def __init__(self, hidden_size, item_num, state_size, dropout, diffuser_type, device, num_heads=1):
+    # step_mlp output of every timestep, see step_emb
+    step_table = None
+    step_table_version = None
+
+    def __init__(self, hidden_size, item_num, state_size, dropout, diffuser_type, device, num_heads=1, timesteps=None, attention='math'):
         super(Tenc, self).__init__()
         self.state_size = state_size
         self.hidden_size = hidden_size
@@ -246,27 +428,22 @@ class Tenc(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.diffuser_type = diffuser_type
         self.device = device
+        # length of the diffusion schedule, the size of the step_emb table (None disables the table)
+        self.timesteps = timesteps
         self.item_embeddings = nn.Embedding(
             num_embeddings=item_num + 1,
             embedding_dim=hidden_size,
         )
         nn.init.normal_(self.item_embeddings.weight, 0, 1)
+        # scoring view of item_embeddings for predict and item indexes, see ItemMatrix
+        self.item_matrix = ItemMatrix(self.item_embeddings)
         self.none_embedding = nn.Embedding(
             num_embeddings=1,
             embedding_dim=self.hidden_size,
         )
         nn.init.normal_(self.none_embedding.weight, 0, 1)
-        self.positional_embeddings = nn.Embedding(
-            num_embeddings=state_size,
-            embedding_dim=hidden_size
-        )
-        # emb_dropout is added
-        self.emb_dropout = nn.Dropout(dropout)
-        self.ln_1 = nn.LayerNorm(hidden_size)
-        self.ln_2 = nn.LayerNorm(hidden_size)
-        self.ln_3 = nn.LayerNorm(hidden_size)
-        self.mh_attn = MultiHeadAttention(hidden_size, hidden_size, num_heads, dropout)
-        self.feed_forward = PositionwiseFeedForward(hidden_size, hidden_size, dropout)
+        self.encoder = SequenceEncoder(hidden_size, state_size, self.item_num, dropout, num_heads, attention=attention)
+        self._register_load_state_dict_pre_hook(SequenceEncoder.upgrade_state_dict)
         self.s_fc = nn.Linear(hidden_size, item_num)
         # self.ac_func = nn.ReLU()
 
@@ -306,9 +483,21 @@ class Tenc(nn.Module):
         )
 
 
+    def step_emb(self, step):
+        # step_mlp depends only on the integer step, so without autograd it is read from a table of
+        # all timesteps that is rebuilt only when the step_mlp weights or self.timesteps change; traced samplers
+        # (torch.compile, CUDA graph capture) run step_mlp itself so that they read its weights live
+        if torch.is_grad_enabled() or torch.compiler.is_compiling() or (step.is_cuda and torch.cuda.is_current_stream_capturing()) or self.timesteps is None:
+            return self.step_mlp(step)
+        version = (self.timesteps, weights_version(self.step_mlp))
+        if self.step_table is None or self.step_table_version != version:
+            self.step_table = self.step_mlp(torch.arange(self.timesteps, device=step.device))
+            self.step_table_version = version
+        return self.step_table[step]
+
     def forward(self, x, h, step):
 
-        t = self.step_mlp(step)
+        t = self.step_emb(step)
 
 
         if self.diffuser_type == 'mlp1':
@@ -318,10 +507,9 @@ class Tenc(nn.Module):
         return res
 
     def forward_uncon(self, x, step):
-        h = self.none_embedding(torch.tensor([0]).to(self.device))
-        h = torch.cat([h.view(1, args.hidden_factor)]*x.shape[0], dim=0)
+        h = self.none_embedding.weight.expand(x.shape[0], -1)
 
-        t = self.step_mlp(step)
+        t = self.step_emb(step)
 
         if self.diffuser_type == 'mlp1':
             res = self.diffuser(torch.cat((x, h, t), dim=1))
@@ -332,6 +520,14 @@ class Tenc(nn.Module):
 
         # return x
 
+    def forward_cfg(self, x, h, step, w):
+        # conditional and unconditional passes of classifier-free guidance as one 2B batch
+        t = self.step_emb(step).repeat(2, 1)
+        h = torch.cat((h, self.none_embedding.weight.expand_as(h)), dim=0)
+        res = self.diffuser(torch.cat((x.repeat(2, 1), h, t), dim=1))
+        res_con, res_uncon = res.chunk(2)
+        return (1 + w) * res_con - w * res_uncon
+
     def cacu_x(self, x):
         x = self.item_embeddings(x)
 
@@ -339,18 +535,7 @@ class Tenc(nn.Module):
 
     def cacu_h(self, states, len_states, p):
         #hidden
-        inputs_emb = self.item_embeddings(states)
-        inputs_emb += self.positional_embeddings(torch.arange(self.state_size).to(self.device))
-        seq = self.emb_dropout(inputs_emb)
-        mask = torch.ne(states, self.item_num).float().unsqueeze(-1).to(self.device)
-        seq *= mask
-        seq_normalized = self.ln_1(seq)
-        mh_attn_out = self.mh_attn(seq_normalized, seq)
-        ff_out = self.feed_forward(self.ln_2(mh_attn_out))
-        ff_out *= mask
-        ff_out = self.ln_3(ff_out)
-        state_hidden = extract_axis_1(ff_out, len_states - 1)
-        h = state_hidden.squeeze()
+        h = self.encoder(self.item_embeddings, states, len_states)
 
         B, D = h.shape[0], h.shape[1]
         mask1d = (torch.sign(torch.rand(B) - p) + 1) / 2
@@ -364,32 +549,36 @@ class Tenc(nn.Module):
 
         return h  
     
-    def predict(self, states, len_states, diff):
-        #hidden
-        inputs_emb = self.item_embeddings(states)
-        inputs_emb += self.positional_embeddings(torch.arange(self.state_size).to(self.device))
-        seq = self.emb_dropout(inputs_emb)
-        mask = torch.ne(states, self.item_num).float().unsqueeze(-1).to(self.device)
-        seq *= mask
-        seq_normalized = self.ln_1(seq)
-        mh_attn_out = self.mh_attn(seq_normalized, seq)
-        ff_out = self.feed_forward(self.ln_2(mh_attn_out))
-        ff_out *= mask
-        ff_out = self.ln_3(ff_out)
-        state_hidden = extract_axis_1(ff_out, len_states - 1)
-        h = state_hidden.squeeze()
-
-        x = diff.sample(self.forward, self.forward_uncon, h)
+    def cacu_state(self, states, len_states):
+        # inference states for predict, no dropout nor p-masking, cached per sequence by the encoder
+        return self.encoder.encode_states(self.item_embeddings, states, len_states)
+
+    def predict(self, states, len_states, diff, num_samples=1, aggregate='mean', sample_chunk=4):
+        h = self.cacu_state(states, len_states)
+
+        if num_samples > 1:
+            # num_samples chains per user, drawn sample_chunk chains at a time, see multi_sample_scores
+            return multi_sample_scores(lambda h: diff.sample(self.forward_cfg, None, h, item_topk=self.item_matrix.topk),
+                                       self.item_matrix.score, h, num_samples=num_samples, aggregate=aggregate, chunk_size=sample_chunk)
+        x = diff.sample(self.forward_cfg, None, h, item_topk=self.item_matrix.topk)
         
-        test_item_emb = self.item_embeddings.weight
-        scores = torch.matmul(x, test_item_emb.transpose(0, 1))
+        scores = self.item_matrix.score(x)
 
         return scores
 
+    def predict_topk(self, states, len_states, diff, k, index=None):
+        # scores and ids of the top k items for one generated embedding per user, searched in an ItemIndex
+        # of self.item_embeddings, or streamed block by block through self.item_matrix when index is None,
+        # instead of scoring the whole catalog
+        h = self.cacu_state(states, len_states)
+        search = index.search if index is not None else self.item_matrix.topk
+        x = diff.sample(self.forward_cfg, None, h, item_topk=search)
+        return search(x, k)
+
 
 
 def evaluate(model, test_data, diff, device):
-    eval_data=pd.read_pickle(os.path.join(data_directory, test_data))
+    eval_data=load_data(data_directory, test_data)
 
     batch_size = 100
     evaluated=0
@@ -401,41 +590,42 @@ def evaluate(model, test_data, diff, device):
     hit_purchase=[0,0,0,0]
     ndcg_purchase=[0,0,0,0]
 
-    seq, len_seq, target = list(eval_data['seq'].values), list(eval_data['len_seq'].values), list(eval_data['next'].values)
+    seq, len_seq, target = eval_data['seq'], eval_data['len_seq'], eval_data['next']
 
 
     num_total = len(seq)
     losses = []
     for i in range(num_total // batch_size):
         seq_b, len_seq_b, target_b = seq[i * batch_size: (i + 1)* batch_size], len_seq[i * batch_size: (i + 1)* batch_size], target[i * batch_size: (i + 1)* batch_size]
-        states = np.array(seq_b)
-        states = torch.LongTensor(states)
+        states = torch.from_numpy(seq_b).long()
         states = states.to(device)
 
         """"""
-        seq_t = torch.LongTensor(seq_b)
-        len_seq_t = torch.LongTensor(len_seq_b)
-        target_t = torch.LongTensor(target_b)
+        seq_t = torch.from_numpy(seq_b).long()
+        len_seq_t = torch.from_numpy(len_seq_b).long()
+        target_t = torch.from_numpy(target_b).long()
 
         seq_t = seq_t.to(device)
         target_t = target_t.to(device)
         len_seq_t = len_seq_t.to(device)
 
-        x_start = model.cacu_x(target_t)
+        with autocast(device, args.precision):
+            x_start = model.cacu_x(target_t)
         
-        h = model.cacu_h(seq_t, len_seq_t, args.p)
+            h = model.cacu_h(seq_t, len_seq_t, args.p)
 
-        n = torch.randint(0, args.timesteps, (h.size()[0], ), device=device).long()
-        loss, predicted_x = diff.p_losses(model, x_start, h, n, loss_type='l2')
-        losses.append(loss.item())
-        """"""
+            n = torch.randint(0, args.timesteps, (h.size()[0], ), device=device).long()
+            loss, predicted_x = diff.p_losses(model, x_start, h, n, loss_type='l2')
+            losses.append(loss.item())
+            """"""
 
-        prediction = model.predict(states, np.array(len_seq_b), diff)
-        _, topK = prediction.topk(10, dim=1, largest=True, sorted=True)
-        topK = topK.cpu().detach().numpy()
-        sorted_list2=np.flip(topK,axis=1)
-        sorted_list2 = sorted_list2
-        calculate_hit(sorted_list2,topk,target_b,hit_purchase,ndcg_purchase)
+            if item_index is not None or args.num_samples == 1:
+                # top-k streamed over the item table (or searched in item_index), no (batch, item_num) scores
+                _, topK = model.predict_topk(states, np.array(len_seq_b), diff, max(topk), item_index)
+            else:
+                prediction = model.predict(states, np.array(len_seq_b), diff, args.num_samples, args.aggregate, args.sample_chunk)
+                _, topK = prediction.topk(max(topk), dim=1, largest=True, sorted=True)
+        calculate_hit_tensor(topK, topk, target_t, hit_purchase, ndcg_purchase)
 
         total_purchase+=batch_size
  
@@ -448,7 +638,7 @@ def evaluate(model, test_data, diff, device):
         ng_purchase=ndcg_purchase[i]/total_purchase
 
         hr_list.append(hr_purchase)
-        ndcg_list.append(ng_purchase[0,0])
+        ndcg_list.append(ng_purchase)
 
         if i == 1:
             hr_20 = hr_purchase
@@ -458,6 +648,108 @@ def evaluate(model, test_data, diff, device):
     return hr_20
 
 
+def timed_predict(model, eval_data, diff, device, batch_size=100, **predict_args):
+    # HR/NDCG@topk of model.predict over eval_data, the seconds spent in it and the reverse steps its rows took
+    seq, len_seq, target = eval_data['seq'], eval_data['len_seq'], eval_data['next']
+    num_batches = len(seq) // batch_size
+    # one untimed batch, so tracing the compiled sampler is not counted as latency
+    with torch.no_grad(), autocast(device, args.precision):
+        model.predict(torch.from_numpy(seq[:batch_size]).long().to(device), np.array(len_seq[:batch_size]), diff, **predict_args)
+    setup_seed(args.random_seed)
+    hit_purchase=[0,0,0]
+    ndcg_purchase=[0,0,0]
+    elapsed = 0.0
+    steps_taken = 0
+    with torch.no_grad():
+        for i in range(num_batches):
+            states = torch.from_numpy(seq[i * batch_size: (i + 1)* batch_size]).long().to(device)
+            len_seq_b = len_seq[i * batch_size: (i + 1)* batch_size]
+            target_t = torch.from_numpy(target[i * batch_size: (i + 1)* batch_size]).long().to(device)
+
+            start = Time.time()
+            with autocast(device, args.precision):
+                prediction = model.predict(states, np.array(len_seq_b), diff, **predict_args)
+            _, topK = prediction.topk(max(topk), dim=1, largest=True, sorted=True)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed += Time.time() - start
+            calculate_hit_tensor(topK, topk, target_t, hit_purchase, ndcg_purchase)
+            if diff.patience > 0:
+                steps_taken += diff.last_sample_steps.sum().item()
+
+    total_purchase = num_batches * batch_size
+    hr_list = [hit / total_purchase for hit in hit_purchase]
+    ndcg_list = [ndcg / total_purchase for ndcg in ndcg_purchase]
+    return hr_list, ndcg_list, elapsed, steps_taken / total_purchase
+
+
+def benchmark_sampler(model, test_data, diff, device, sample_steps):
+    # HR@10/NDCG@10 against prediction latency of the full ddpm chain and of each ddim length,
+    # avg steps are the reverse steps a row took on average (fewer than steps with --patience)
+    eval_data=load_data(data_directory, test_data)
+    batch_size = 100
+    num_batches = len(eval_data['seq']) // batch_size
+    model.eval()
+    print('{:<8s} {:>6s} {:>10s} {:>10s} {:>10s} {:>12s}'.format('sampler', 'steps', 'avg steps', 'HR@'+str(topk[1]), 'NDCG@'+str(topk[1]), 'ms/batch'))
+    for sampler, steps in [('ddpm', 0)] + [('ddim', steps) for steps in sample_steps]:
+        diff.set_sampler(sampler, steps, args.eta, args.compile_sampler, args.patience, args.patience_k, args.tolerance)
+        hr_list, ndcg_list, elapsed, steps_taken = timed_predict(model, eval_data, diff, device, batch_size)
+        chain = len(diff.ddim_timesteps()) if sampler == 'ddim' else diff.timesteps
+        print('{:<8s} {:>6d} {:>10.2f} {:>10.6f} {:>10.6f} {:>12.2f}'.format(sampler, chain, steps_taken if args.patience > 0 else chain,
+              hr_list[1], ndcg_list[1], 1000 * elapsed / num_batches))
+    diff.set_sampler(args.sampler, args.sample_steps, args.eta, args.compile_sampler, args.patience, args.patience_k, args.tolerance)
+
+
+def benchmark_samples(model, test_data, diff, device, num_samples):
+    # HR@10/NDCG@10 against throughput for several chains per user and both aggregations
+    eval_data=load_data(data_directory, test_data)
+    batch_size = 100
+    model.eval()
+    print('{:<8s} {:<10s} {:>10s} {:>10s} {:>12s}'.format('samples', 'aggregate', 'HR@'+str(topk[1]), 'NDCG@'+str(topk[1]), 'users/sec'))
+    for samples in num_samples:
+        for aggregate in (['mean'] if samples == 1 else ['mean', 'rank']):
+            hr_list, ndcg_list, elapsed, _ = timed_predict(model, eval_data, diff, device, batch_size,
+                                                           num_samples=samples, aggregate=aggregate, sample_chunk=args.sample_chunk)
+            users = len(eval_data['seq']) // batch_size * batch_size
+            print('{:<8d} {:<10s} {:>10.6f} {:>10.6f} {:>12.1f}'.format(samples, aggregate, hr_list[1], ndcg_list[1], users / elapsed))
+
+
+def check_compiled_sampler(model, diff, device, batch_size=100):
+    # the compiled sampler against the eager one under the same seed
+    h = torch.randn(batch_size, args.hidden_factor, device=device)
+    compiled = diff.compiled
+    outputs = []
+    print('{:<10s} {:>12s}'.format('sampler', 'ms/batch'))
+    for name, flag in [('eager', False), ('compiled', True)]:
+        diff.set_sampler(diff.sampler, diff.sample_steps, diff.eta, flag, diff.patience, diff.patience_k, diff.tolerance)
+        diff.sample(model.forward_cfg, None, h)
+        setup_seed(args.random_seed)
+        start = Time.time()
+        outputs.append(diff.sample(model.forward_cfg, None, h))
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        print('{:<10s} {:>12.2f}'.format(name, 1000 * (Time.time() - start)))
+    error = (outputs[0] - outputs[1]).abs().max().item()
+    print('compiled sampler max abs difference: {:.2e}'.format(error))
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-4), 'compiled sampler does not match the eager sampler'
+
+    # an in-place update of the weights, as optimizer.step() does, is read by the traced sampler without a retrace
+    state = {name: value.clone() for name, value in model.state_dict().items()}
+    samplers = dict(model.compiled_samplers)
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.add_(0.01 * torch.randn_like(parameter))
+    outputs = []
+    for flag in [False, True]:
+        diff.set_sampler(diff.sampler, diff.sample_steps, diff.eta, flag, diff.patience, diff.patience_k, diff.tolerance)
+        setup_seed(args.random_seed)
+        outputs.append(diff.sample(model.forward_cfg, None, h))
+    model.load_state_dict(state)
+    diff.set_sampler(diff.sampler, diff.sample_steps, diff.eta, compiled, diff.patience, diff.patience_k, diff.tolerance)
+    assert all(model.compiled_samplers[key] is sampler for key, sampler in samplers.items()), 'compiled sampler was traced again'
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-4), 'compiled sampler does not follow in-place weight updates'
+
+
 if __name__ == '__main__':
 
     # args = parse_args()
@@ -474,8 +766,24 @@ if __name__ == '__main__':
     timesteps = args.timesteps
 
     # args.hidden_factor = 32
-    model = Tenc(args.hidden_factor,item_num, seq_size, args.dropout_rate, args.diffuser_type, device)
-    diff = diffusion(args.timesteps, args.beta_start, args.beta_end, args.w)
+    model = Tenc(args.hidden_factor,item_num, seq_size, args.dropout_rate, args.diffuser_type, device, timesteps=args.timesteps, attention=args.attention)
+    diff = diffusion(args.timesteps, args.beta_start, args.beta_end, args.w).to(device)
+    diff.set_sampler(args.sampler, args.sample_steps, args.eta, args.compile_sampler, args.patience, args.patience_k, args.tolerance)
+    model.item_matrix = ItemMatrix(model.item_embeddings, dtype=args.item_dtype)
+    item_index = ItemIndex(model.item_matrix, args.item_index, nlist=args.nlist or None, nprobe=args.nprobe) if args.item_index != 'none' else None
+
+    if args.bench_sampler or args.bench_samples:
+        model.load_state_dict(torch.load(f"./models/tencVG{args.checkpoint}.pth", map_location=device))
+        diff = torch.load(f"./models/diffVG{args.checkpoint}.pth", map_location=device).to(device)
+        diff.set_sampler(args.sampler, args.sample_steps, args.eta, args.compile_sampler, args.patience, args.patience_k, args.tolerance)
+        model.to(device)
+        if args.compile_sampler:
+            check_compiled_sampler(model, diff, device)
+        if args.bench_sampler:
+            benchmark_sampler(model, 'test_data', diff, device, [int(steps) for steps in args.bench_sampler.split(',')])
+        if args.bench_samples:
+            benchmark_samples(model, 'test_data', diff, device, [int(samples) for samples in args.bench_samples.split(',')])
+        raise SystemExit
 
     if args.optimizer == 'adam':
         optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, eps=1e-8, weight_decay=args.l2_decay)
@@ -490,41 +798,40 @@ if __name__ == '__main__':
     
     model.to(device)
     # optimizer.to(device)
+    if args.compile_sampler:
+        check_compiled_sampler(model, diff, device)
 
-    train_data = pd.read_pickle(os.path.join(data_directory, 'train_data.df'))
+    train_data = load_data(data_directory, 'train_data')
     
     total_step=0
     hr_max = 0
     best_epoch = 0
 
-    num_rows=train_data.shape[0]
-    num_batches=int(num_rows/args.batch_size)
+    # loss scaling only for fp16, a pass-through otherwise
+    scaler = torch.amp.GradScaler(device.type, enabled=args.precision == 'fp16')
+
+    train_loader = TensorBatcher(train_data, args.batch_size, columns=('seq', 'len_seq', 'next'), pin_memory=args.pin_memory, device=device)
     for i in range(args.epoch):
         start_time = Time.time()
-        for j in range(num_batches):
-            batch = train_data.sample(n=args.batch_size).to_dict()
-            seq = list(batch['seq'].values())
-            len_seq = list(batch['len_seq'].values())
-            target=list(batch['next'].values())
+        batches = Prefetcher(train_loader, args.prefetch, device) if args.prefetch > 0 else train_loader
+        for j, batch in enumerate(batches):
+            seq = batch['seq']
+            len_seq = batch['len_seq']
+            target = batch['next']
             
             optimizer.zero_grad()
-            seq = torch.LongTensor(seq)
-            len_seq = torch.LongTensor(len_seq)
-            target = torch.LongTensor(target)
 
-            seq = seq.to(device)
-            target = target.to(device)
-            len_seq = len_seq.to(device)
-
-            x_start = model.cacu_x(target)
-            
-            h = model.cacu_h(seq, len_seq, args.p)
+            with autocast(device, args.precision):
+                x_start = model.cacu_x(target)
+                
+                h = model.cacu_h(seq, len_seq, args.p)
 
-            n = torch.randint(0, args.timesteps, (args.batch_size, ), device=device).long()
-            loss, predicted_x = diff.p_losses(model, x_start, h, n, loss_type='l2')
+                n = torch.randint(0, args.timesteps, (args.batch_size, ), device=device).long()
+                loss, predicted_x = diff.p_losses(model, x_start, h, n, loss_type='l2')
 
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
 
         # scheduler.step()
@@ -532,14 +839,16 @@ if __name__ == '__main__':
             if i % 1 == 0:
                 print("Epoch {:03d}; ".format(i) + 'Train loss: {:.4f}; '.format(loss) + "Time cost: " + Time.strftime(
                         "%H: %M: %S", Time.gmtime(Time.time()-start_time)))
+                if args.prefetch > 0:
+                    print("Data wait: {:.3f}s".format(batches.wait_time))
 
             if (i + 1) % 10 == 0:
                 
                 eval_start = Time.time()
                 print('-------------------------- VAL PHRASE --------------------------')
-                _ = evaluate(model, 'val_data.df', diff, device)
+                _ = evaluate(model, 'val_data', diff, device)
                 print('-------------------------- TEST PHRASE -------------------------')
-                _ = evaluate(model, 'test_data.df', diff, device)
+                _ = evaluate(model, 'test_data', diff, device)
                 print("Evalution cost: " + Time.strftime("%H: %M: %S", Time.gmtime(Time.time()-eval_start)))
                 print('----------------------------------------------------------------')
 
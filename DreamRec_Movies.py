@@ -7,10 +7,12 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import torch.optim.lr_scheduler as lr_scheduler
+import torch.distributed as dist
 import os
+import hashlib
 import logging
 import time as Time
-from utility import pad_history,calculate_hit,extract_axis_1
+from utility import pad_history,calculate_hit,calculate_hit_tensor,extract_axis_1,weights_version,compiled_sample,multi_sample_scores,ItemMatrix,decoder_topk,SampledSoftmaxLoss,autocast,load_data,TensorBatcher,Prefetcher,broadcast_module,all_reduce_gradients
 from collections import Counter
 from Modules_ori import *
 
@@ -59,6 +61,23 @@ def parse_args():
                         help='')
     parser.add_argument('--descri', type=str, default='',
                         help='description of the work.')
+    parser.add_argument('--pin_memory', action='store_true', default=False,
+                        help='gather training batches into pinned memory.')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='batches prepared ahead by a background thread, 0 disables prefetching.')
+    parser.add_argument('--decoder_loss', type=str, default='full', choices=['full', 'sampled', 'inbatch'],
+                        help='training loss of the decoder: full softmax, sampled softmax or in-batch negatives, both with logQ correction.')
+    parser.add_argument('--num_negatives', type=int, default=1000,
+                        help='negatives per step of --decoder_loss sampled.')
+    parser.add_argument('--attention', type=str, default='math', choices=['math', 'sdpa'],
+                        help='MultiHeadAttention backend: explicit masks and softmax, or F.scaled_dot_product_attention.')
+    parser.add_argument('--genre_samples', type=int, default=0,
+                        help='precompute this many genre conditioning samples per row instead of running the genre model every step, 0 disables; '
+                             'each sample keeps its timestep, which the item diffusion shares as it does without the cache.')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='autocast precision of training, p_losses and the sampler; fp16 trains with loss scaling.')
+    parser.add_argument('--distributed', action='store_true', default=False,
+                        help='data parallel training over torch.distributed (gloo), launched by torchrun; --batch_size is per rank.')
     return parser.parse_args()
 
 args = parse_args()
@@ -74,9 +93,10 @@ setup_seed(args.random_seed)
 
 
 def extract(a, t, x_shape):
+    # a is kept on the device of t (see diffusion.to), .to() is then a no-op and nothing syncs with the host
     batch_size = t.shape[0]
-    out = a.gather(-1, t.cpu())
-    return out.reshape(batch_size, *((1,) * (len(x_shape) - 1))).to(t.device)
+    out = a.to(t.device).gather(-1, t)
+    return out.reshape(batch_size, *((1,) * (len(x_shape) - 1)))
 
 def linear_beta_schedule(timesteps, beta_start, beta_end):
     beta_start = beta_start
@@ -115,6 +135,16 @@ def betas_for_alpha_bar(num_diffusion_timesteps, alpha_bar, max_beta=0.999):
     return np.array(betas)
 
 class diffusion():
+    # reverse process used by sample, see set_sampler
+    sampler = 'ddpm'
+    sample_steps = 0
+    eta = 0.0
+    compiled = False
+    patience = 0
+    patience_k = 10
+    tolerance = float('inf')
+    last_sample_steps = None
+
     def __init__(self, timesteps, beta_start, beta_end, w):
         self.timesteps = timesteps
         self.beta_start = beta_start
@@ -149,6 +179,13 @@ class diffusion():
 
         # calculations for posterior q(x_{t-1} | x_t, x_0)
         self.posterior_variance = self.betas * (1. - self.alphas_cumprod_prev) / (1. - self.alphas_cumprod)
+
+    def to(self, device):
+        # move the schedule buffers next to the model
+        for name, value in vars(self).items():
+            if torch.is_tensor(value):
+                setattr(self, name, value.to(device))
+        return self
     
     def q_sample(self, x_start, t, noise=None):
         # print(self.betas)
@@ -192,10 +229,15 @@ class diffusion():
             extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
         )
     
-    @torch.no_grad()
-    def p_sample(self, model_forward, model_forward_uncon, x, h, t, t_index):
-
-        x_start = (1 + self.w) * model_forward(x, h, t) - self.w * model_forward_uncon(x, t)
+    def guided_start(self, model_forward, model_forward_uncon, x, h, t, *cond):
+        # classifier-free guidance, model_forward_uncon=None means model_forward(x, h, t, *cond, w)
+        # returns the guided x_0 itself from one fused conditional + unconditional batch
+        if model_forward_uncon is None:
+            return model_forward(x, h, t, *cond, self.w)
+        return (1 + self.w) * model_forward(x, h, t, *cond) - self.w * model_forward_uncon(x, t, *cond)
+
+    def posterior_sample(self, x_start, x, t, t_index, noise=None):
+        # x_{t-1} drawn from q(x_{t-1} | x_t, x_0) with the predicted x_0, its mean at t_index 0
         x_t = x 
         model_mean = (
             extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
@@ -206,15 +248,128 @@ class diffusion():
             return model_mean
         else:
             posterior_variance_t = extract(self.posterior_variance, t, x.shape)
-            noise = torch.randn_like(x)
+            if noise is None:
+                noise = torch.randn_like(x)
 
             return model_mean + torch.sqrt(posterior_variance_t) * noise 
+
+    @torch.no_grad()
+    def p_sample(self, model_forward, model_forward_uncon, x, h, t, t_index, noise=None):
+
+        x_start = self.guided_start(model_forward, model_forward_uncon, x, h, t)
+        return self.posterior_sample(x_start, x, t, t_index, noise)
         
+    def set_sampler(self, sampler='ddpm', sample_steps=0, eta=0.0, compiled=False, patience=0, patience_k=10, tolerance=float('inf')):
+        """
+        Select the reverse process used by sample.
+        :param sampler: 'ddpm' walks every timestep, 'ddim' a strided subsequence of them.
+        :param sample_steps: length of the ddim subsequence, 0 uses every timestep.
+        :param eta: ddim noise scale, 0 is deterministic and 1 matches the ddpm posterior variance.
+        :param compiled: trace the reverse loop once per batch shape and replay it, see utility.CompiledSampler.
+        :param patience: retire a row after its top patience_k items were stable for this many steps,
+                         see adaptive_sample; 0 runs every row through the whole chain.
+        :param patience_k: size of the ranking checked for stability.
+        :param tolerance: largest relative change of the predicted x_0 still counted as stable.
+        """
+        if sampler not in ('ddpm', 'ddim'):
+            raise ValueError('unknown sampler: {}'.format(sampler))
+        self.sampler = sampler
+        self.sample_steps = sample_steps
+        self.eta = eta
+        self.compiled = compiled
+        self.patience = patience
+        self.patience_k = patience_k
+        self.tolerance = tolerance
+
+    def ddim_timesteps(self):
+        # evenly spaced subsequence of [timesteps - 1, ..., 0], descending
+        steps = min(self.sample_steps or self.timesteps, self.timesteps)
+        return torch.linspace(self.timesteps - 1, 0, steps).round().long().unique_consecutive().tolist()
+
+    def ddim_step(self, x, x_start, alpha_cumprod, alpha_cumprod_prev, noise=None):
+        # x at the previous ddim timestep from x and the predicted x_0, alpha_cumprod_prev = 1 returns x_0
+        predicted_noise = (x - math.sqrt(alpha_cumprod) * x_start) / math.sqrt(1. - alpha_cumprod)
+        sigma = self.eta * math.sqrt((1. - alpha_cumprod_prev) / (1. - alpha_cumprod) * (1. - alpha_cumprod / alpha_cumprod_prev))
+        x_prev = math.sqrt(alpha_cumprod_prev) * x_start + math.sqrt(max(1. - alpha_cumprod_prev - sigma ** 2, 0.)) * predicted_noise
+        if sigma > 0:
+            if noise is None:
+                noise = torch.randn_like(x)
+            x_prev = x_prev + sigma * noise
+        return x_prev
+
     @torch.no_grad()
-    def sample(self, model_forward, model_forward_uncon, h):
+    def p_sample_ddim(self, model_forward, model_forward_uncon, x, h, t, alpha_cumprod, alpha_cumprod_prev, noise=None):
+        x_start = self.guided_start(model_forward, model_forward_uncon, x, h, t)
+        return self.ddim_step(x, x_start, alpha_cumprod, alpha_cumprod_prev, noise)
+
+    @torch.no_grad()
+    def adaptive_sample(self, model_forward, model_forward_uncon, h, item_topk, *cond):
+        """
+        Reverse loop that retires a row once the top patience_k items of its predicted x_0, scored by
+        item_topk (x_0, k -> scores, ids), kept the same ranking for patience steps, with x_0 moving by at most tolerance
+        (relative norm) per step; a retired row returns that x_0 and is dropped from the batch.
+        last_sample_steps holds the reverse steps every row took.
+        """
+        if self.sampler == 'ddim':
+            timesteps = self.ddim_timesteps()
+            alphas_cumprod = self.alphas_cumprod.tolist() + [1.0]
+        else:
+            timesteps = list(reversed(range(0, self.timesteps)))
+        batch_size = h.shape[0]
+        output = torch.empty_like(h)
+        steps = torch.full((batch_size, ), len(timesteps), dtype=torch.long, device=h.device)
+        active = torch.arange(batch_size, device=h.device)
+        stable = torch.zeros(batch_size, dtype=torch.long, device=h.device)
+        previous_start, previous_topk = None, None
+        x = torch.randn_like(h)
+
+        for i, (n, n_prev) in enumerate(zip(timesteps, timesteps[1:] + [-1])):
+            t = torch.full((x.shape[0], ), n, device=h.device, dtype=torch.long)
+            x_start = self.guided_start(model_forward, model_forward_uncon, x, h, t, *cond)
+            if self.sampler == 'ddim':
+                x = self.ddim_step(x, x_start, alphas_cumprod[n], alphas_cumprod[n_prev])
+            else:
+                x = self.posterior_sample(x_start, x, t, n)
+
+            _, topk = item_topk(x_start, self.patience_k)
+            if previous_topk is not None:
+                change = (x_start - previous_start).norm(dim=1) / previous_start.norm(dim=1).clamp_min(1e-12)
+                same = torch.eq(topk, previous_topk).all(dim=1) & (change <= self.tolerance)
+                stable = torch.where(same, stable + 1, torch.zeros_like(stable))
+            done = stable >= self.patience
+            if i + 1 < len(timesteps) and done.any():
+                output[active[done]] = x_start[done]
+                steps[active[done]] = i + 1
+                keep = ~done
+                active, x, h, x_start, topk, stable = active[keep], x[keep], h[keep], x_start[keep], topk[keep], stable[keep]
+                cond = [c[keep] for c in cond]
+                if len(active) == 0:
+                    break
+            previous_start, previous_topk = x_start, topk
+
+        output[active] = x
+        self.last_sample_steps = steps
+        return output
+
+    @torch.no_grad()
+    def sample(self, model_forward, model_forward_uncon, h, item_topk=None):
+        # item_topk, the top-k item search of samples (ItemMatrix.topk, ItemIndex.search), enables early exit when patience > 0
+        if self.patience > 0 and item_topk is not None:
+            return self.adaptive_sample(model_forward, model_forward_uncon, h, item_topk)
+        if self.compiled:
+            return compiled_sample(self, model_forward, model_forward_uncon, h)
+
         x = torch.randn_like(h)
         # x = torch.randn_like(h) / 100
 
+        if self.sampler == 'ddim':
+            timesteps = self.ddim_timesteps()
+            # host copy read once per call, index -1 (after the last step) is alpha_cumprod = 1
+            alphas_cumprod = self.alphas_cumprod.tolist() + [1.0]
+            for n, n_prev in zip(timesteps, timesteps[1:] + [-1]):
+                x = self.p_sample_ddim(model_forward, model_forward_uncon, x, h, torch.full((h.shape[0], ), n, device=device, dtype=torch.long), alphas_cumprod[n], alphas_cumprod[n_prev])
+            return x
+
         for n in reversed(range(0, self.timesteps)):
             x = self.p_sample(model_forward, model_forward_uncon, x, h, torch.full((h.shape[0], ), n, device=device, dtype=torch.long), n)
 
@@ -251,28 +406,34 @@ class MovieDiffusion(diffusion):
         return loss, predicted_x
 
     @torch.no_grad()
-    def p_sample(self, model_forward, model_forward_uncon, x, h, t, t_index, genres_embd):
+    def p_sample(self, model_forward, model_forward_uncon, x, h, t, t_index, genres_embd, noise=None):
 
-        x_start = (1 + self.w) * model_forward(x, h, t, genres_embd) - self.w * model_forward_uncon(x, t, genres_embd)
-        x_t = x 
-        model_mean = (
-            extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-            extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-
-        if t_index == 0:
-            return model_mean
-        else:
-            posterior_variance_t = extract(self.posterior_variance, t, x.shape)
-            noise = torch.randn_like(x)
-
-            return model_mean + torch.sqrt(posterior_variance_t) * noise 
+        x_start = self.guided_start(model_forward, model_forward_uncon, x, h, t, genres_embd)
+        return self.posterior_sample(x_start, x, t, t_index, noise)
         
     @torch.no_grad()
-    def sample(self, model_forward, model_forward_uncon, h, genres_embd):
+    def p_sample_ddim(self, model_forward, model_forward_uncon, x, h, t, alpha_cumprod, alpha_cumprod_prev, genres_embd, noise=None):
+        x_start = self.guided_start(model_forward, model_forward_uncon, x, h, t, genres_embd)
+        return self.ddim_step(x, x_start, alpha_cumprod, alpha_cumprod_prev, noise)
+
+    @torch.no_grad()
+    def sample(self, model_forward, model_forward_uncon, h, genres_embd, item_topk=None):
+        if self.patience > 0 and item_topk is not None:
+            return self.adaptive_sample(model_forward, model_forward_uncon, h, item_topk, genres_embd)
+        if self.compiled:
+            return compiled_sample(self, model_forward, model_forward_uncon, h, genres_embd)
+
         x = torch.randn_like(h)
         # x = torch.randn_like(h) / 100
 
+        if self.sampler == 'ddim':
+            timesteps = self.ddim_timesteps()
+            # host copy read once per call, index -1 (after the last step) is alpha_cumprod = 1
+            alphas_cumprod = self.alphas_cumprod.tolist() + [1.0]
+            for n, n_prev in zip(timesteps, timesteps[1:] + [-1]):
+                x = self.p_sample_ddim(model_forward, model_forward_uncon, x, h, torch.full((h.shape[0], ), n, device=device, dtype=torch.long), alphas_cumprod[n], alphas_cumprod[n_prev], genres_embd)
+            return x
+
         for n in reversed(range(0, self.timesteps)):
             x = self.p_sample(model_forward, model_forward_uncon, x, h, torch.full((h.shape[0], ), n, device=device, dtype=torch.long), n, genres_embd)
 
@@ -296,7 +457,11 @@ class SinusoidalPositionEmbeddings(nn.Module):
     
         
 class Tenc(nn.Module):
-    def __init__(self, hidden_size, item_num, state_size, dropout, diffuser_type, device, num_heads=1):
+    # step_mlp output of every timestep, see step_emb
+    step_table = None
+    step_table_version = None
+
+    def __init__(self, hidden_size, item_num, state_size, dropout, diffuser_type, device, num_heads=1, timesteps=None, attention='math'):
         super(Tenc, self).__init__()
         self.state_size = state_size
         self.hidden_size = hidden_size
@@ -304,28 +469,23 @@ class Tenc(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.diffuser_type = diffuser_type
         self.device = device
+        # length of the diffusion schedule, the size of the step_emb table (None disables the table)
+        self.timesteps = timesteps
         self.item_embeddings = nn.Embedding(
             num_embeddings=item_num + 1,
             embedding_dim=hidden_size,
         )
         
         nn.init.normal_(self.item_embeddings.weight, 0, 1)
+        # scoring view of item_embeddings for predict and item indexes, see ItemMatrix
+        self.item_matrix = ItemMatrix(self.item_embeddings)
         self.none_embedding = nn.Embedding(
             num_embeddings=1,
             embedding_dim=self.hidden_size,
         )
         nn.init.normal_(self.none_embedding.weight, 0, 1)
-        self.positional_embeddings = nn.Embedding(
-            num_embeddings=state_size,
-            embedding_dim=hidden_size
-        )
-        # emb_dropout is added
-        self.emb_dropout = nn.Dropout(dropout)
-        self.ln_1 = nn.LayerNorm(hidden_size)
-        self.ln_2 = nn.LayerNorm(hidden_size)
-        self.ln_3 = nn.LayerNorm(hidden_size)
-        self.mh_attn = MultiHeadAttention(hidden_size, hidden_size, num_heads, dropout)
-        self.feed_forward = PositionwiseFeedForward(hidden_size, hidden_size, dropout)
+        self.encoder = SequenceEncoder(hidden_size, state_size, self.item_num, dropout, num_heads, attention=attention)
+        self._register_load_state_dict_pre_hook(SequenceEncoder.upgrade_state_dict)
         self.s_fc = nn.Linear(hidden_size, item_num)
         # self.ac_func = nn.ReLU()
 
@@ -367,9 +527,21 @@ class Tenc(nn.Module):
                
 
 
+    def step_emb(self, step):
+        # step_mlp depends only on the integer step, so without autograd it is read from a table of
+        # all timesteps that is rebuilt only when the step_mlp weights or self.timesteps change; traced samplers
+        # (torch.compile, CUDA graph capture) run step_mlp itself so that they read its weights live
+        if torch.is_grad_enabled() or torch.compiler.is_compiling() or (step.is_cuda and torch.cuda.is_current_stream_capturing()) or self.timesteps is None:
+            return self.step_mlp(step)
+        version = (self.timesteps, weights_version(self.step_mlp))
+        if self.step_table is None or self.step_table_version != version:
+            self.step_table = self.step_mlp(torch.arange(self.timesteps, device=step.device))
+            self.step_table_version = version
+        return self.step_table[step]
+
     def forward(self, x, h, step):
 
-        t = self.step_mlp(step)
+        t = self.step_emb(step)
 
 
         if self.diffuser_type == 'mlp1':
@@ -379,10 +551,9 @@ class Tenc(nn.Module):
         return res
 
     def forward_uncon(self, x, step):
-        h = self.none_embedding(torch.tensor([0]).to(self.device))
-        h = torch.cat([h.view(1, args.hidden_factor)]*x.shape[0], dim=0)
+        h = self.none_embedding.weight.expand(x.shape[0], -1)
 
-        t = self.step_mlp(step)
+        t = self.step_emb(step)
 
         if self.diffuser_type == 'mlp1':
             res = self.diffuser(torch.cat((x, h, t), dim=1))
@@ -393,24 +564,21 @@ class Tenc(nn.Module):
 
         # return x
 
+    def forward_cfg(self, x, h, step, w):
+        # conditional and unconditional passes of classifier-free guidance as one 2B batch
+        t = self.step_emb(step).repeat(2, 1)
+        h = torch.cat((h, self.none_embedding.weight.expand_as(h)), dim=0)
+        res = self.diffuser(torch.cat((x.repeat(2, 1), h, t), dim=1))
+        res_con, res_uncon = res.chunk(2)
+        return (1 + w) * res_con - w * res_uncon
+
     def cacu_x(self, x):
         x = self.item_embeddings(x)
         return x
 
     def cacu_h(self, states, len_states, p):
         #hidden
-        inputs_emb = self.item_embeddings(states)
-        inputs_emb += self.positional_embeddings(torch.arange(self.state_size).to(self.device))
-        seq = self.emb_dropout(inputs_emb)
-        mask = torch.ne(states, self.item_num).float().unsqueeze(-1).to(self.device)
-        seq *= mask
-        seq_normalized = self.ln_1(seq)
-        mh_attn_out = self.mh_attn(seq_normalized, seq)
-        ff_out = self.feed_forward(self.ln_2(mh_attn_out))
-        ff_out *= mask
-        ff_out = self.ln_3(ff_out)
-        state_hidden = extract_axis_1(ff_out, len_states - 1)
-        h = state_hidden.squeeze()
+        h = self.encoder(self.item_embeddings, states, len_states)
 
         B, D = h.shape[0], h.shape[1]
         mask1d = (torch.sign(torch.rand(B) - p) + 1) / 2
@@ -424,30 +592,34 @@ class Tenc(nn.Module):
 
         return h  
     
-    def predict(self, states, len_states, diff):
-        #hidden
-        inputs_emb = self.item_embeddings(states)
-        inputs_emb += self.positional_embeddings(torch.arange(self.state_size).to(self.device))
-        seq = self.emb_dropout(inputs_emb)
-        mask = torch.ne(states, self.item_num).float().unsqueeze(-1).to(self.device)
-        seq *= mask
-        seq_normalized = self.ln_1(seq)
-        mh_attn_out = self.mh_attn(seq_normalized, seq)
-        ff_out = self.feed_forward(self.ln_2(mh_attn_out))
-        ff_out *= mask
-        ff_out = self.ln_3(ff_out)
-        state_hidden = extract_axis_1(ff_out, len_states - 1)
-        h = state_hidden.squeeze()
-
-        x = diff.sample(self.forward, self.forward_uncon, h)
+    def cacu_state(self, states, len_states):
+        # inference states for predict, no dropout nor p-masking, cached per sequence by the encoder
+        return self.encoder.encode_states(self.item_embeddings, states, len_states)
+
+    def predict(self, states, len_states, diff, num_samples=1, aggregate='mean', sample_chunk=4):
+        h = self.cacu_state(states, len_states)
+
+        if num_samples > 1:
+            # num_samples chains per user, drawn sample_chunk chains at a time, see multi_sample_scores
+            return multi_sample_scores(lambda h: diff.sample(self.forward_cfg, None, h, item_topk=self.item_matrix.topk),
+                                       self.item_matrix.score, h, num_samples=num_samples, aggregate=aggregate, chunk_size=sample_chunk)
+        x = diff.sample(self.forward_cfg, None, h, item_topk=self.item_matrix.topk)
         
-        test_item_emb = self.item_embeddings.weight
-        scores = torch.matmul(x, test_item_emb.transpose(0, 1))
+        scores = self.item_matrix.score(x)
 
         return scores
 
+    def predict_topk(self, states, len_states, diff, k, index=None):
+        # scores and ids of the top k items for one generated embedding per user, searched in an ItemIndex
+        # of self.item_embeddings, or streamed block by block through self.item_matrix when index is None,
+        # instead of scoring the whole catalog
+        h = self.cacu_state(states, len_states)
+        search = index.search if index is not None else self.item_matrix.topk
+        x = diff.sample(self.forward_cfg, None, h, item_topk=search)
+        return search(x, k)
+
 class MovieTenc(Tenc):
-    def __init__(self, hidden_size, item_num, state_size, dropout, diffuser_type, device, num_heads=1):
+    def __init__(self, hidden_size, item_num, state_size, dropout, diffuser_type, device, num_heads=1, timesteps=None, attention='math'):
         super(Tenc, self).__init__()
         self.state_size = state_size
         self.hidden_size = hidden_size
@@ -455,27 +627,22 @@ class MovieTenc(Tenc):
         self.dropout = nn.Dropout(dropout)
         self.diffuser_type = diffuser_type
         self.device = device
+        # length of the diffusion schedule, the size of the step_emb table (None disables the table)
+        self.timesteps = timesteps
         self.item_embeddings = nn.Embedding(
             num_embeddings=item_num + 1,
             embedding_dim=hidden_size,
         )
         nn.init.normal_(self.item_embeddings.weight, 0, 1)
+        # cosine scores of predict, see ItemMatrix
+        self.item_matrix = ItemMatrix(self.item_embeddings, normalize=True)
         self.none_embedding = nn.Embedding(
             num_embeddings=1,
             embedding_dim=self.hidden_size,
         )
         nn.init.normal_(self.none_embedding.weight, 0, 1)
-        self.positional_embeddings = nn.Embedding(
-            num_embeddings=state_size,
-            embedding_dim=hidden_size
-        )
-        # emb_dropout is added
-        self.emb_dropout = nn.Dropout(dropout)
-        self.ln_1 = nn.LayerNorm(hidden_size)
-        self.ln_2 = nn.LayerNorm(hidden_size)
-        self.ln_3 = nn.LayerNorm(hidden_size)
-        self.mh_attn = MultiHeadAttention(hidden_size, hidden_size, num_heads, dropout)
-        self.feed_forward = PositionwiseFeedForward(hidden_size, hidden_size, dropout)
+        self.encoder = SequenceEncoder(hidden_size, state_size, self.item_num, dropout, num_heads, attention=attention)
+        self._register_load_state_dict_pre_hook(SequenceEncoder.upgrade_state_dict)
         self.s_fc = nn.Linear(hidden_size, item_num)
         # self.ac_func = nn.ReLU()
 
@@ -543,7 +710,7 @@ class MovieTenc(Tenc):
 
     def forward(self, x, h, step, genres_embd):
 
-        t = self.step_mlp(step)
+        t = self.step_emb(step)
 
 
         if self.diffuser_type == 'mlp1':
@@ -553,10 +720,9 @@ class MovieTenc(Tenc):
         return res
 
     def forward_uncon(self, x, step, genres_embd):
-        h = self.none_embedding(torch.tensor([0]).to(self.device))
-        h = torch.cat([h.view(1, 64)]*x.shape[0], dim=0)
+        h = self.none_embedding.weight.expand(x.shape[0], -1)
 
-        t = self.step_mlp(step)
+        t = self.step_emb(step)
 
         if self.diffuser_type == 'mlp1':
             res = self.diffuser(torch.cat((x, h, t, genres_embd), dim=1))
@@ -565,34 +731,40 @@ class MovieTenc(Tenc):
             
         return res
 
-    def predict(self, states, len_states, diff, genres_embd):
-        #hidden
-        inputs_emb = self.item_embeddings(states)
-        inputs_emb += self.positional_embeddings(torch.arange(self.state_size).to(self.device))
-        seq = self.emb_dropout(inputs_emb)
-        mask = torch.ne(states, self.item_num).float().unsqueeze(-1).to(self.device)
-        seq *= mask
-        seq_normalized = self.ln_1(seq)
-        mh_attn_out = self.mh_attn(seq_normalized, seq)
-        ff_out = self.feed_forward(self.ln_2(mh_attn_out))
-        ff_out *= mask
-        ff_out = self.ln_3(ff_out)
-        state_hidden = extract_axis_1(ff_out, len_states - 1)
-        h = state_hidden.squeeze()
-
-        x = diff.sample(self.forward, self.forward_uncon, h, genres_embd)
+    def forward_cfg(self, x, h, step, genres_embd, w):
+        # conditional and unconditional passes of classifier-free guidance as one 2B batch
+        t = self.step_emb(step).repeat(2, 1)
+        h = torch.cat((h, self.none_embedding.weight.expand_as(h)), dim=0)
+        res = self.diffuser(torch.cat((x.repeat(2, 1), h, t, genres_embd.repeat(2, 1)), dim=1))
+        res_con, res_uncon = res.chunk(2)
+        return (1 + w) * res_con - w * res_uncon
+
+    def predict(self, states, len_states, diff, genres_embd, num_samples=1, aggregate='mean', sample_chunk=4):
+        h = self.cacu_state(states, len_states)
+
+        # the normalized item table is cached in self.item_matrix until the weights change
+        if num_samples > 1:
+            return multi_sample_scores(lambda h, genres_embd: diff.sample(self.forward_cfg, None, h, genres_embd, item_topk=self.item_matrix.topk),
+                                       self.item_matrix.score, h, genres_embd, num_samples=num_samples, aggregate=aggregate, chunk_size=sample_chunk)
+        x = diff.sample(self.forward_cfg, None, h, genres_embd, item_topk=self.item_matrix.topk)
         
-        test_item_emb = self.item_embeddings.weight
         # scores = torch.matmul(x, test_item_emb.transpose(0, 1))
-        scores = torch.matmul(x / x.norm(dim=-1, keepdim=True), 
-                      (test_item_emb / test_item_emb.norm(dim=-1, keepdim=True)).transpose(0, 1))
+        scores = self.item_matrix.score(x)
 
 
         return scores
 
+    def predict_topk(self, states, len_states, diff, genres_embd, k, index=None):
+        # predict through an ItemIndex built on self.item_matrix, or its blocked top-k when index is None,
+        # for the cosine scores of predict
+        h = self.cacu_state(states, len_states)
+        search = index.search if index is not None else self.item_matrix.topk
+        x = diff.sample(self.forward_cfg, None, h, genres_embd, item_topk=search)
+        return search(x, k)
+
 
 def evaluate(model, genre_model, genre_diff, test_data, diff, device):
-    eval_data=pd.read_pickle(os.path.join(data_directory, test_data))
+    eval_data=load_data(data_directory, test_data)
 
     batch_size = 100
     evaluated=0
@@ -604,8 +776,8 @@ def evaluate(model, genre_model, genre_diff, test_data, diff, device):
     hit_purchase=[0,0,0,0]
     ndcg_purchase=[0,0,0,0]
 
-    seq, len_seq, target = list(eval_data['seq'].values), list(eval_data['len_seq'].values), list(eval_data['next'].values)
-    genre_seq, genre_len_seq, genre_target = list(eval_data['seq_genres'].values), list(eval_data['len_seq'].values), list(eval_data['target_genre'].values)
+    seq, len_seq, target = eval_data['seq'], eval_data['len_seq'], eval_data['next']
+    genre_seq, genre_len_seq, genre_target = eval_data['seq_genres'], eval_data['len_seq'], eval_data['target_genre']
 
     num_total = len(seq)
     losses = []
@@ -613,59 +785,55 @@ def evaluate(model, genre_model, genre_diff, test_data, diff, device):
         seq_b, len_seq_b, target_b = seq[i * batch_size: (i + 1)* batch_size], len_seq[i * batch_size: (i + 1)* batch_size], target[i * batch_size: (i + 1)* batch_size]
         genre_seq_b, genre_len_seq_b, genre_target_b = genre_seq[i * batch_size: (i + 1)* batch_size], genre_len_seq[i * batch_size: (i + 1)* batch_size], genre_target[i * batch_size: (i + 1)* batch_size]
         
-        states = np.array(seq_b)
-        states = torch.LongTensor(states)
+        states = torch.from_numpy(seq_b).long()
         states = states.to(device)
         
         """"""
-        seq_t = torch.LongTensor(seq_b)
-        len_seq_t = torch.LongTensor(len_seq_b)
-        target_t = torch.LongTensor(target_b)
+        seq_t = torch.from_numpy(seq_b).long()
+        len_seq_t = torch.from_numpy(len_seq_b).long()
+        target_t = torch.from_numpy(target_b).long()
 
         seq_t = seq_t.to(device)
         target_t = target_t.to(device)
         len_seq_t = len_seq_t.to(device)
 
-        x_start = model.cacu_x(target_t)
+        with autocast(device, args.precision):
+            x_start = model.cacu_x(target_t)
 
-        h = model.cacu_h(seq_t, len_seq_t, args.p)
-        n = torch.randint(0, args.timesteps, (h.size()[0], ), device=device).long()
-        """"""
+            h = model.cacu_h(seq_t, len_seq_t, args.p)
+            n = torch.randint(0, args.timesteps, (h.size()[0], ), device=device).long()
+            """"""
         
-        """Add genres data to specified device"""
-        genre_seq_b = torch.LongTensor(genre_seq_b)
-        genre_len_seq_b = torch.LongTensor(genre_len_seq_b)
-        genre_target_b = torch.LongTensor(genre_target_b)
-
-        genre_seq_b = genre_seq_b.to(device)
-        genre_target_b = genre_target_b.to(device)
-        genre_len_seq_b = genre_len_seq_b.to(device)
+            """Add genres data to specified device"""
+            genre_seq_b = torch.from_numpy(genre_seq_b).long()
+            genre_len_seq_b = torch.from_numpy(genre_len_seq_b).long()
+            genre_target_b = torch.from_numpy(genre_target_b).long()
+
+            genre_seq_b = genre_seq_b.to(device)
+            genre_target_b = genre_target_b.to(device)
+            genre_len_seq_b = genre_len_seq_b.to(device)
         
-        n = torch.randint(0, args.timesteps, (batch_size, ), device=device).long()
-        genre_x_start = genre_model.cacu_x(genre_target_b)
-        genre_h = genre_model.cacu_h(genre_seq_b, genre_len_seq_b, args.p)
-        _, genre_predicted_x= genre_diff.p_losses(genre_model, genre_x_start, genre_h, n, loss_type='l2')
-        """"""
+            if test_data in genre_caches:
+                genre_predicted_x, n = draw_genre_conditioning(genre_caches[test_data], torch.arange(i * batch_size, (i + 1) * batch_size), device)
+            else:
+                n = torch.randint(0, args.timesteps, (batch_size, ), device=device).long()
+                genre_x_start = genre_model.cacu_x(genre_target_b)
+                genre_h = genre_model.cacu_h(genre_seq_b, genre_len_seq_b, args.p)
+                _, genre_predicted_x= genre_diff.p_losses(genre_model, genre_x_start, genre_h, n, loss_type='l2')
+            """"""
 
-        loss, predicted_x = diff.p_losses(model, x_start, h, n, genres_embd=genre_predicted_x, loss_type='l2')
+            loss, predicted_x = diff.p_losses(model, x_start, h, n, genres_embd=genre_predicted_x, loss_type='l2')
 
-        predicted_items = model.decoder(predicted_x)
-        # loss = loss_function(predicted_items, target_t)
+            # loss = loss_function(predicted_items, target_t)
         
-        losses.append(loss.item())
+            losses.append(loss.item())
         
-        # prediction = model.predict(states, np.array(len_seq_b), diff, genre_predicted_x)
-        # assert False, (np.shape(prediction,), np.shape(predicted_x))
-        try:
             # prediction = model.predict(states, np.array(len_seq_b), diff, genre_predicted_x)
-            prediction = F.softmax(predicted_items, dim=-1)
-            _, topK = prediction.topk(10, dim=1, largest=True, sorted=True)
-            topK = topK.cpu().detach().numpy()
-            sorted_list2=np.flip(topK,axis=1)
-            sorted_list2 = sorted_list2
-            calculate_hit(sorted_list2,topk,target_b,hit_purchase,ndcg_purchase)
-        except:
-            pass
+            # assert False, (np.shape(prediction,), np.shape(predicted_x))
+            # prediction = model.predict(states, np.array(len_seq_b), diff, genre_predicted_x)
+            # top-k decoder logits streamed over the output layer, softmax does not change the ranking
+            _, topK = decoder_topk(model.decoder, predicted_x, max(topk))
+        calculate_hit_tensor(topK, topk, target_t, hit_purchase, ndcg_purchase)
 
         total_purchase+=batch_size
  
@@ -677,13 +845,8 @@ def evaluate(model, genre_model, genre_diff, test_data, diff, device):
     for i in range(len(topk)):
         hr_purchase=hit_purchase[i]/total_purchase
         ng_purchase=ndcg_purchase[i]/total_purchase
-        # assert False, ndcg_purchase
-        try:
-            hr_list.append(hr_purchase)
-            # assert False, ng_purchase
-            ndcg_list.append(ng_purchase[0,0])
-        except:
-            pass
+        hr_list.append(hr_purchase)
+        ndcg_list.append(ng_purchase)
 
         if i == 1:
             hr_20 = hr_purchase
@@ -697,11 +860,66 @@ def evaluate(model, genre_model, genre_diff, test_data, diff, device):
     return hr_20
 
 def load_genres_predictor(tenc, tenc_path='models/tencVG949.pth', diff_path='models/diffVG949.pth'):
-    tenc.load_state_dict(torch.load(tenc_path))
-    diff = torch.load(diff_path)
+    tenc.load_state_dict(torch.load(tenc_path, map_location=device))
+    diff = torch.load(diff_path, map_location=device).to(device)
     
     return tenc, diff
 
+@torch.no_grad()
+def genre_conditioning(genre_model, genre_diff, data, name, samples, batch_size=1024):
+    """
+    genre_predicted_x of every row of data, as the training loop draws it: samples draws per row, each with its own
+    timestep, noise and p-masking, computed in batched no_grad passes of the frozen genre model.
+    They are stored memory-mapped, float16 (rows, samples, hidden_size) next to the int32 (rows, samples) timesteps,
+    under data_directory/genre_cache with a fingerprint of the genre model, the schedule, p and the genre columns
+    of data in the file names.
+    :return: (conditioning, timesteps) memmaps, see draw_genre_conditioning.
+    """
+    fingerprint = hashlib.sha1()
+    for tensor in genre_model.state_dict().values():
+        fingerprint.update(tensor.detach().cpu().numpy().tobytes())
+    fingerprint.update(genre_diff.betas.detach().cpu().numpy().tobytes())
+    fingerprint.update(repr((samples, args.p)).encode())
+    # the rows themselves, so that a rebuilt or resplit dataset does not read the samples of the old one
+    num_rows = len(data['seq_genres'])
+    fingerprint.update(repr(num_rows).encode())
+    for column in ['seq_genres', 'len_seq', 'target_genre']:
+        fingerprint.update(np.ascontiguousarray(data[column]).tobytes())
+    path = os.path.join(data_directory, 'genre_cache', '{}_{}'.format(name, fingerprint.hexdigest()[:12]))
+    if not (os.path.exists(path + '_x.npy') and os.path.exists(path + '_t.npy')):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conditioning = np.lib.format.open_memmap(path + '_x.tmp.npy', mode='w+', dtype=np.float16, shape=(num_rows, samples, genre_model.hidden_size))
+        timesteps = np.zeros((num_rows, samples), dtype=np.int32)
+        for start in range(0, num_rows, batch_size):
+            genre_seq = torch.from_numpy(np.asarray(data['seq_genres'][start:start + batch_size])).long().to(device)
+            genre_len_seq = torch.from_numpy(np.asarray(data['len_seq'][start:start + batch_size])).long().to(device)
+            genre_target = torch.from_numpy(np.asarray(data['target_genre'][start:start + batch_size])).long().to(device)
+            genre_x_start = genre_model.cacu_x(genre_target)
+            for k in range(samples):
+                n = torch.randint(0, args.timesteps, (len(genre_seq), ), device=device).long()
+                genre_h = genre_model.cacu_h(genre_seq, genre_len_seq, args.p)
+                _, genre_predicted_x = genre_diff.p_losses(genre_model, genre_x_start, genre_h, n, loss_type='l2')
+                conditioning[start:start + batch_size, k] = genre_predicted_x.cpu().numpy()
+                timesteps[start:start + batch_size, k] = n.cpu().numpy()
+        conditioning.flush()
+        del conditioning
+        np.save(path + '_t.npy', timesteps)
+        os.replace(path + '_x.tmp.npy', path + '_x.npy')
+    conditioning, timesteps = np.load(path + '_x.npy', mmap_mode='r'), np.load(path + '_t.npy')
+    if len(conditioning) != num_rows or len(timesteps) != num_rows:
+        raise ValueError('genre cache {} has {} rows, {} has {}'.format(path, len(conditioning), name, num_rows))
+    return conditioning, timesteps
+
+def draw_genre_conditioning(genre_cache, rows, device):
+    # one of the precomputed samples of every row and the timestep it was drawn at, which the item diffusion
+    # shares as it shares n with the genre diffusion without the cache
+    conditioning, timesteps = genre_cache
+    rows = rows.cpu().numpy()
+    k = torch.randint(0, conditioning.shape[1], (len(rows), )).numpy()
+    genre_predicted_x = torch.from_numpy(conditioning[rows, k]).to(device).float()
+    n = torch.from_numpy(timesteps[rows, k]).to(device).long()
+    return genre_predicted_x, n
+
 def one_hot_encoding(target, item_num):
     num = target.size()[0]
     encoded_target = torch.zeros(num, item_num) 
@@ -732,13 +950,19 @@ if __name__ == '__main__':
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     timesteps = args.timesteps
 
+    # every rank trains on its shard of the rows, rank 0 evaluates, reports and saves
+    rank, world_size = 0, 1
+    if args.distributed:
+        dist.init_process_group('gloo')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+
     #args.hidden_factor = 2048
-    model = MovieTenc(args.hidden_factor,item_num, seq_size, args.dropout_rate, args.diffuser_type, device)
-    diff = MovieDiffusion(args.timesteps, args.beta_start, args.beta_end, args.w)
+    model = MovieTenc(args.hidden_factor,item_num, seq_size, args.dropout_rate, args.diffuser_type, device, timesteps=args.timesteps, attention=args.attention)
+    diff = MovieDiffusion(args.timesteps, args.beta_start, args.beta_end, args.w).to(device)
     
     """Load Genres' Models"""
-    genre_model = Tenc(args.hidden_factor,genres_item_num, genres_seq_size, args.dropout_rate, args.diffuser_type, device)
-    genre_diff = diffusion(args.timesteps, args.beta_start, args.beta_end, args.w)
+    genre_model = Tenc(args.hidden_factor,genres_item_num, genres_seq_size, args.dropout_rate, args.diffuser_type, device, timesteps=args.timesteps, attention=args.attention)
+    genre_diff = diffusion(args.timesteps, args.beta_start, args.beta_end, args.w).to(device)
     genre_model, genre_diff = load_genres_predictor(genre_model)
     genre_model.eval()
     
@@ -760,13 +984,34 @@ if __name__ == '__main__':
     # scheduler = lr_scheduler.LinearLR(optimizer, start_factor=0.1, end_factor=1, total_iters=20)
     
     model.to(device)
+    if world_size > 1:
+        broadcast_module(model)
     
     """Load the genres model into the specified device"""
     genre_model.to(device)
     """"""
     # optimizer.to(device)
 
-    train_data = pd.read_pickle(os.path.join(data_directory, 'train_data.df'))
+    train_data = load_data(data_directory, 'train_data')
+
+    # frozen genre model outputs of every split, computed once, see genre_conditioning
+    genre_caches = {}
+    if args.genre_samples > 0:
+        precompute_start = Time.time()
+        if rank != 0:
+            # rank 0 writes the files, the other ranks read them
+            dist.barrier()
+        for name in ['train_data', 'val_data', 'test_data']:
+            data = train_data if name == 'train_data' else load_data(data_directory, name)
+            genre_caches[name] = genre_conditioning(genre_model, genre_diff, data, name, args.genre_samples)
+        if rank == 0 and world_size > 1:
+            dist.barrier()
+        if rank == 0:
+            print("Genre conditioning: " + Time.strftime("%H: %M: %S", Time.gmtime(Time.time()-precompute_start)))
+        train_data = dict(train_data, row=np.arange(len(train_data['seq'])))
+    if world_size > 1:
+        # different timesteps, noise and p-masking on every rank
+        setup_seed(args.random_seed + rank)
 
     total_step=0
     hr_max = 0
@@ -774,90 +1019,100 @@ if __name__ == '__main__':
     
     #Loss function
     loss_function = nn.CrossEntropyLoss()
+    if args.decoder_loss != 'full':
+        # only the target and negative rows of the decoder output layer are computed, evaluation stays exact
+        item_counts = np.bincount(train_data['next'], minlength=item_num)
+        loss_function = SampledSoftmaxLoss(item_counts, args.decoder_loss, args.num_negatives).to(device)
+
+    # loss scaling only for fp16, a pass-through otherwise
+    scaler = torch.amp.GradScaler(device.type, enabled=args.precision == 'fp16')
 
-    num_rows=train_data.shape[0]
-    num_batches=int(num_rows/args.batch_size)
+    columns = ('seq', 'len_seq', 'next', 'seq_genres', 'target_genre') + (('row', ) if genre_caches else ())
+    train_loader = TensorBatcher(train_data, args.batch_size, columns=columns, pin_memory=args.pin_memory, device=device,
+                                 num_shards=world_size, shard=rank, seed=args.random_seed)
     for i in range(args.epoch):
         start_time = Time.time()
-        for j in range(num_batches):
-            batch = train_data.sample(n=args.batch_size).to_dict()
-            seq = list(batch['seq'].values())
-            len_seq = list(batch['len_seq'].values())
-            target=list(batch['next'].values())
+        batches = Prefetcher(train_loader, args.prefetch, device) if args.prefetch > 0 else train_loader
+        for j, batch in enumerate(batches):
+            seq = batch['seq']
+            len_seq = batch['len_seq']
+            target = batch['next']
             
             """Get data related to genres from the batch"""
-            genre_seq = list(batch['seq_genres'].values())
-            genre_len_seq = list(batch['len_seq'].values())
-            genre_target=list(batch['target_genre'].values())
+            genre_seq = batch['seq_genres']
+            genre_len_seq = batch['len_seq']
+            genre_target = batch['target_genre']
             """"""
 
             optimizer.zero_grad()
-            seq = torch.LongTensor(seq)
-            len_seq = torch.LongTensor(len_seq)
-            target = torch.LongTensor(target)
-
-            seq = seq.to(device)
-            target = target.to(device)
-            len_seq = len_seq.to(device)
-            
-            """Add genres data to specified device"""
-            genre_seq = torch.LongTensor(genre_seq)
-            genre_len_seq = torch.LongTensor(genre_len_seq)
-            genre_target = torch.LongTensor(genre_target)
-
-            genre_seq = genre_seq.to(device)
-            genre_target = genre_target.to(device)
-            genre_len_seq = genre_len_seq.to(device)
-            """"""
 
-            x_start = model.cacu_x(target)
+            with autocast(device, args.precision):
+                x_start = model.cacu_x(target)
+                h = model.cacu_h(seq, len_seq, args.p)
 
-            n = torch.randint(0, args.timesteps, (args.batch_size, ), device=device).long()
-            h = model.cacu_h(seq, len_seq, args.p)
-            
-            """Calculate x_start for genres"""
-            genre_x_start = genre_model.cacu_x(genre_target)
-            genre_h = genre_model.cacu_h(genre_seq, genre_len_seq, args.p)
-            _, genre_predicted_x= genre_diff.p_losses(genre_model, genre_x_start, genre_h, n, loss_type='l2')
+                if genre_caches:
+                    genre_predicted_x, n = draw_genre_conditioning(genre_caches['train_data'], batch['row'], device)
+                else:
+                    n = torch.randint(0, args.timesteps, (args.batch_size, ), device=device).long()
+                
+                    """Calculate x_start for genres"""
+                    with torch.no_grad():
+                        genre_x_start = genre_model.cacu_x(genre_target)
+                        genre_h = genre_model.cacu_h(genre_seq, genre_len_seq, args.p)
+                        _, genre_predicted_x= genre_diff.p_losses(genre_model, genre_x_start, genre_h, n, loss_type='l2')
             
-            """"""
+                """"""
 
 
-            loss1, predicted_x = diff.p_losses(model, x_start, h, n, genres_embd=genre_predicted_x, loss_type='l2')
-            # loss.backward()
-            # optimizer.step()   
+                loss1, predicted_x = diff.p_losses(model, x_start, h, n, genres_embd=genre_predicted_x, loss_type='l2')
+                # loss.backward()
+                # optimizer.step()   
             
-            # encoded_target = one_hot_encoding(target, item_num).to(device)       
+                # encoded_target = one_hot_encoding(target, item_num).to(device)       
             
-            predicted_items = model.decoder(predicted_x)
-            loss2 = loss_function(predicted_items, target)
+                if args.decoder_loss == 'full':
+                    predicted_items = model.decoder(predicted_x)
+                    loss2 = loss_function(predicted_items, target)
+                else:
+                    loss2 = loss_function(model.decoder[:-1](predicted_x), model.decoder[-1], target)
             
-            loss = loss1 + loss2
+                loss = loss1 + loss2
             
-            loss.backward()
-            optimizer.step()  
+            scaler.scale(loss).backward()
+            if world_size > 1:
+                all_reduce_gradients(model)
+            scaler.step(optimizer)
+            scaler.update()
             
-            # _ = evaluate(model, genre_model, genre_diff, 'val_data.df', diff, device)
+            # _ = evaluate(model, genre_model, genre_diff, 'val_data', diff, device)
 
 
         # scheduler.step()
-        if args.report_epoch:
+        if args.report_epoch and rank == 0:
             if i % 1 == 0:
                 print("Epoch {:03d}; ".format(i) + 'Train loss: {:.4f}; '.format(loss) + "Time cost: " + Time.strftime(
                         "%H: %M: %S", Time.gmtime(Time.time()-start_time)))
+                if args.prefetch > 0:
+                    print("Data wait: {:.3f}s".format(batches.wait_time))
 
             if (i + 1) % 10 == 0:
                 
                 eval_start = Time.time()
                 print('-------------------------- VAL PHRASE --------------------------')
-                _ = evaluate(model, genre_model, genre_diff, 'val_data.df', diff, device)
+                _ = evaluate(model, genre_model, genre_diff, 'val_data', diff, device)
                 print('-------------------------- TEST PHRASE -------------------------')
-                _ = evaluate(model, genre_model, genre_diff, 'test_data.df', diff, device)
+                _ = evaluate(model, genre_model, genre_diff, 'test_data', diff, device)
                 print("Evalution cost: " + Time.strftime("%H: %M: %S", Time.gmtime(Time.time()-eval_start)))
                 print('----------------------------------------------------------------')
 
                 torch.save(model.state_dict(), f"./models/tencV{i}.pth")
                 torch.save(diff, f"./models/diffV{i}.pth")
+        if world_size > 1:
+            # the other ranks wait here for rank 0 to evaluate and save, instead of in the next all_reduce
+            dist.barrier()
+
+    if args.distributed:
+        dist.destroy_process_group()
 
 
                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                      
@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from collections import OrderedDict
+from utility import extract_axis_1, weights_version
 
 
 
@@ -24,18 +26,30 @@ class PositionwiseFeedForward(nn.Module):
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, hidden_size, num_units, num_heads, dropout_rate):
+    backend = 'math'
+
+    def __init__(self, hidden_size, num_units, num_heads, dropout_rate, backend='math'):
         super().__init__()
         self.hidden_size = hidden_size
         self.num_heads = num_heads
         assert hidden_size % num_heads == 0
+        assert backend in ('math', 'sdpa')
+        # 'math' is the explicit bmm/softmax below, 'sdpa' the same attention through F.scaled_dot_product_attention
+        self.backend = backend
         
         self.linear_q = nn.Linear(hidden_size, num_units)
         self.linear_k = nn.Linear(hidden_size, num_units)
         self.linear_v = nn.Linear(hidden_size, num_units)
         self.dropout = nn.Dropout(dropout_rate)
         self.softmax = nn.Softmax(dim=-1)
+        # lower triangular boolean mask, grown to the longest sequence seen and sliced per call
+        self.register_buffer('causal_mask', torch.ones(0, 0, dtype=torch.bool), persistent=False)
 
+    def causal(self, T_q, T_k, device):
+        if self.causal_mask.shape[0] < T_q or self.causal_mask.shape[1] < T_k or self.causal_mask.device != device:
+            size = max(T_q, T_k, self.causal_mask.shape[0])
+            self.causal_mask = torch.ones(size, size, dtype=torch.bool, device=device).tril()
+        return self.causal_mask[:T_q, :T_k]
 
     def forward(self, queries, keys):
         """
@@ -45,6 +59,9 @@ class MultiHeadAttention(nn.Module):
         :return: A 3d tensor with shape of (N, T_q, C)
         
         """
+        if self.backend == 'sdpa':
+            return self.forward_sdpa(queries, keys)
+
         Q = self.linear_q(queries)  # (N, T_q, C)
         K = self.linear_k(keys)  # (N, T_k, C)
         V = self.linear_v(keys)  # (N, T_k, C)
@@ -92,4 +109,118 @@ class MultiHeadAttention(nn.Module):
         output_res = output + queries
         
         return output_res
-        
+
+    def forward_sdpa(self, queries, keys):
+        # forward with view-based heads and one boolean mask instead of the repeated (h*N, T_q, T_k) masks and paddings
+        N, T_q, T_k = queries.shape[0], queries.shape[1], keys.shape[1]
+        split_size = self.hidden_size // self.num_heads
+        Q = self.linear_q(queries).view(N, T_q, -1, split_size).transpose(1, 2)  # (N, h, T_q, C/h)
+        K = self.linear_k(keys).view(N, T_k, -1, split_size).transpose(1, 2)  # (N, h, T_k, C/h)
+        V = self.linear_v(keys).view(N, T_k, -1, split_size).transpose(1, 2)  # (N, h, T_k, C/h)
+
+        # Key Masking and Causality, a row with every key masked attends to all keys uniformly as with the paddings
+        mask = self.causal(T_q, T_k, queries.device) & torch.ne(keys.sum(dim=-1), 0)[:, None, None, :]  # (N, 1, T_q, T_k)
+        mask = mask | ~mask.any(dim=-1, keepdim=True)
+
+        output = F.scaled_dot_product_attention(Q, K, V, attn_mask=mask, dropout_p=self.dropout.p if self.training else 0.0,
+                                                scale=self.hidden_size ** -0.5)  # (N, h, T_q, C/h)
+        output = output.transpose(1, 2).reshape(N, T_q, -1)  # (N, T_q, C)
+
+        # Query Masking, applied to the output rows rather than the attention weights
+        query_mask = torch.ne(queries.sum(dim=-1), 0).unsqueeze(-1).to(output.dtype)  # (N, T_q, 1)
+
+        # Residual Connection
+        return output * query_mask + queries
+
+
+
+class SequenceEncoder(nn.Module):
+    """
+    The state encoder shared by Tenc, MovieTenc and SASRec: positional embeddings, self-attention and feed
+    forward over the item embeddings of a padded sequence, returning the hidden state at its last item.
+    :param hidden_size: embedding size.
+    :param state_size: length of the padded sequences.
+    :param pad_item: id of the padding item, masked out of the sequence.
+    :param cache_size: sequences whose states encode_states keeps.
+    :param attention: MultiHeadAttention backend, 'math' or 'sdpa'.
+    """
+    # submodules, they were attributes of the models themselves in older checkpoints, see upgrade_state_dict
+    layers = ('positional_embeddings', 'emb_dropout', 'ln_1', 'ln_2', 'ln_3', 'mh_attn', 'feed_forward')
+
+    def __init__(self, hidden_size, state_size, pad_item, dropout, num_heads=1, cache_size=100000, attention='math'):
+        super().__init__()
+        self.state_size = state_size
+        self.pad_item = pad_item
+        self.positional_embeddings = nn.Embedding(
+            num_embeddings=state_size,
+            embedding_dim=hidden_size
+        )
+        # emb_dropout is added
+        self.emb_dropout = nn.Dropout(dropout)
+        self.ln_1 = nn.LayerNorm(hidden_size)
+        self.ln_2 = nn.LayerNorm(hidden_size)
+        self.ln_3 = nn.LayerNorm(hidden_size)
+        self.mh_attn = MultiHeadAttention(hidden_size, hidden_size, num_heads, dropout, backend=attention)
+        self.feed_forward = PositionwiseFeedForward(hidden_size, hidden_size, dropout)
+        self.register_buffer('positions', torch.arange(state_size), persistent=False)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_version = None
+
+    def forward(self, item_embeddings, states, len_states):
+        """
+        :param item_embeddings: nn.Embedding of the items.
+        :param states: (B, state_size) item ids, padded with pad_item.
+        :param len_states: (B, ) lengths, tensor or numpy array.
+        :return: (B, hidden_size) states.
+        """
+        inputs_emb = item_embeddings(states)
+        inputs_emb += self.positional_embeddings(self.positions)
+        seq = self.emb_dropout(inputs_emb)
+        mask = torch.ne(states, self.pad_item).float().unsqueeze(-1)
+        seq *= mask
+        seq_normalized = self.ln_1(seq)
+        mh_attn_out = self.mh_attn(seq_normalized, seq)
+        ff_out = self.feed_forward(self.ln_2(mh_attn_out))
+        ff_out *= mask
+        ff_out = self.ln_3(ff_out)
+        state_hidden = extract_axis_1(ff_out, len_states - 1)
+        return state_hidden.squeeze(1)
+
+    @torch.no_grad()
+    def encode_states(self, item_embeddings, states, len_states):
+        # inference states, without dropout whatever the mode of the module; rows are looked up by their
+        # (sequence, length) and only the unseen ones are encoded, the cache is dropped when the weights change
+        version = (weights_version(self), weights_version(item_embeddings))
+        if version != self.cache_version:
+            self.cache.clear()
+            self.cache_version = version
+        len_states = torch.as_tensor(len_states).cpu()
+        keys = [(row.tobytes(), int(length)) for row, length in zip(states.cpu().numpy(), len_states)]
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            if key in self.cache:
+                # least recently used first, so that popitem(last=False) evicts the stalest sequences
+                self.cache.move_to_end(key)
+            elif key not in missing:
+                missing[key] = i
+        if missing:
+            rows = list(missing.values())
+            training = self.training
+            self.eval()
+            try:
+                encoded = self.forward(item_embeddings, states[rows], len_states[rows])
+            finally:
+                self.train(training)
+            self.cache.update(zip(missing, encoded))
+        h = torch.stack([self.cache[key] for key in keys])
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return h
+
+    @classmethod
+    def upgrade_state_dict(cls, state_dict, prefix, *args):
+        # load_state_dict pre-hook of the models: renames their old encoder keys (ln_1.weight) to encoder.ln_1.weight
+        for key in list(state_dict.keys()):
+            if key.startswith(prefix) and key[len(prefix):].split('.')[0] in cls.layers:
+                state_dict[prefix + 'encoder.' + key[len(prefix):]] = state_dict.pop(key)
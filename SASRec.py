@@ -7,7 +7,7 @@ import torch.nn.functional as F
 import os
 import logging
 import time as Time
-from utility import pad_history,calculate_hit,extract_axis_1
+from utility import pad_history,calculate_hit,calculate_hit_tensor,extract_axis_1,autocast,load_data,TensorBatcher
 from collections import Counter
 from Modules_ori import *
 
@@ -53,10 +53,16 @@ def parse_args():
                         help='dropout ')
     parser.add_argument('--descri', type=str, default='',
                         help='description of the work.')
+    parser.add_argument('--pin_memory', action='store_true', default=False,
+                        help='gather training batches into pinned memory.')
+    parser.add_argument('--attention', type=str, default='math', choices=['math', 'sdpa'],
+                        help='MultiHeadAttention backend: explicit masks and softmax, or F.scaled_dot_product_attention.')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='autocast precision of training and evaluation; fp16 trains with loss scaling.')
     return parser.parse_args()
 
 class SASRec(nn.Module):
-    def __init__(self, hidden_size, item_num, state_size, dropout, device, num_heads=1):
+    def __init__(self, hidden_size, item_num, state_size, dropout, device, num_heads=1, attention='math'):
         super(SASRec, self).__init__()
         self.state_size = state_size
         self.hidden_size = hidden_size
@@ -68,56 +74,27 @@ class SASRec(nn.Module):
             embedding_dim=hidden_size,
         )
         nn.init.normal_(self.item_embeddings.weight, 0, 1)
-        self.positional_embeddings = nn.Embedding(
-            num_embeddings=state_size,
-            embedding_dim=hidden_size
-        )
-        # emb_dropout is added
-        self.emb_dropout = nn.Dropout(dropout)
-        self.ln_1 = nn.LayerNorm(hidden_size)
-        self.ln_2 = nn.LayerNorm(hidden_size)
-        self.ln_3 = nn.LayerNorm(hidden_size)
-        self.mh_attn = MultiHeadAttention(hidden_size, hidden_size, num_heads, dropout)
-        self.feed_forward = PositionwiseFeedForward(hidden_size, hidden_size, dropout)
+        self.encoder = SequenceEncoder(hidden_size, state_size, self.item_num, dropout, num_heads, attention=attention)
+        self._register_load_state_dict_pre_hook(SequenceEncoder.upgrade_state_dict)
         self.s_fc = nn.Linear(hidden_size, item_num)
         # self.ac_func = nn.ReLU()
 
     def forward(self, states, len_states):
         # inputs_emb = self.item_embeddings(states) * self.item_embeddings.embedding_dim ** 0.5
-        inputs_emb = self.item_embeddings(states)
-        inputs_emb += self.positional_embeddings(torch.arange(self.state_size).to(self.device))
-        seq = self.emb_dropout(inputs_emb)
-        mask = torch.ne(states, self.item_num).float().unsqueeze(-1).to(self.device)
-        seq *= mask
-        seq_normalized = self.ln_1(seq)
-        mh_attn_out = self.mh_attn(seq_normalized, seq)
-        ff_out = self.feed_forward(self.ln_2(mh_attn_out))
-        ff_out *= mask
-        ff_out = self.ln_3(ff_out)
-        state_hidden = extract_axis_1(ff_out, len_states - 1)
-        supervised_output = self.s_fc(state_hidden).squeeze()
+        h = self.encoder(self.item_embeddings, states, len_states)
+        supervised_output = self.s_fc(h)
         return supervised_output
 
     def forward_eval(self, states, len_states):
         # inputs_emb = self.item_embeddings(states) * self.item_embeddings.embedding_dim ** 0.5
-        inputs_emb = self.item_embeddings(states)
-        inputs_emb += self.positional_embeddings(torch.arange(self.state_size).to(self.device))
-        seq = self.emb_dropout(inputs_emb)
-        mask = torch.ne(states, self.item_num).float().unsqueeze(-1).to(self.device)
-        seq *= mask
-        seq_normalized = self.ln_1(seq)
-        mh_attn_out = self.mh_attn(seq_normalized, seq)
-        ff_out = self.feed_forward(self.ln_2(mh_attn_out))
-        ff_out *= mask
-        ff_out = self.ln_3(ff_out)
-        state_hidden = extract_axis_1(ff_out, len_states - 1)
-        supervised_output = self.s_fc(state_hidden).squeeze()
+        h = self.encoder.encode_states(self.item_embeddings, states, len_states)
+        supervised_output = self.s_fc(h)
         return supervised_output
 
 
 
 def evaluate(model, test_data, device):
-    eval_data=pd.read_pickle(os.path.join(data_directory, test_data))
+    eval_data=load_data(data_directory, test_data)
 
     batch_size = 100
     evaluated=0
@@ -129,21 +106,19 @@ def evaluate(model, test_data, device):
     hit_purchase=[0,0,0,0]
     ndcg_purchase=[0,0,0,0]
 
-    seq, len_seq, target = list(eval_data['seq']), list(eval_data['len_seq']), list(eval_data['next'])
+    seq, len_seq, target = eval_data['seq'], eval_data['len_seq'], eval_data['next']
 
     num_total = len(seq)
 
     for i in range(num_total // batch_size):
         seq_b, len_seq_b, target_b = seq[i * batch_size: (i + 1)* batch_size], len_seq[i * batch_size: (i + 1)* batch_size], target[i * batch_size: (i + 1)* batch_size]
-        states = np.array(seq_b)
-        states = torch.LongTensor(states)
+        states = torch.from_numpy(seq_b).long()
         states = states.to(device)
 
-        prediction = model.forward_eval(states, np.array(len_seq_b))
-        _, topK = prediction.topk(100, dim=1, largest=True, sorted=True)
-        topK = topK.cpu().detach().numpy()
-        sorted_list2=np.flip(topK,axis=1)
-        calculate_hit(sorted_list2,topk,target_b,hit_purchase,ndcg_purchase)
+        with autocast(device, args.precision):
+            prediction = model.forward_eval(states, np.array(len_seq_b))
+        _, topK = prediction.topk(max(topk), dim=1, largest=True, sorted=True)
+        calculate_hit_tensor(topK, topk, target_b, hit_purchase, ndcg_purchase)
 
         total_purchase+=batch_size
     # while evaluated<len(eval_ids):
@@ -205,7 +180,7 @@ def evaluate(model, test_data, device):
         # print(ng_purchase)
 
         hr_list.append(hr_purchase)
-        ndcg_list.append(ng_purchase[0,0])
+        ndcg_list.append(ng_purchase)
         # ndcg_list.append(ng_purchase)
 
         if i == 1:
@@ -258,7 +233,7 @@ if __name__ == '__main__':
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
-    model = SASRec(args.hidden_factor,item_num, seq_size, args.dropout_rate, device)
+    model = SASRec(args.hidden_factor,item_num, seq_size, args.dropout_rate, device, attention=args.attention)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, eps=1e-8, weight_decay=args.l2_decay)
     bce_loss = nn.BCEWithLogitsLoss()
 
@@ -266,7 +241,7 @@ if __name__ == '__main__':
     model.to(device)
     # optimizer.to(device)
 
-    train_data = pd.read_pickle(os.path.join(data_directory, 'train_data.df'))
+    train_data = load_data(data_directory, 'train_data')
     ps = calcu_propensity_score(train_data)
     ps = torch.tensor(ps)
     ps = ps.to(device)
@@ -275,53 +250,47 @@ if __name__ == '__main__':
     hr_max = 0
     best_epoch = 0
 
-    num_rows=train_data.shape[0]
-    num_batches=int(num_rows/args.batch_size)
+    # loss scaling only for fp16, a pass-through otherwise
+    scaler = torch.amp.GradScaler(device.type, enabled=args.precision == 'fp16')
+
+    train_loader = TensorBatcher(train_data, args.batch_size, columns=('seq', 'len_seq', 'next'), pin_memory=args.pin_memory, device=device)
     for i in range(args.epoch):
-        for j in range(num_batches):
-            batch = train_data.sample(n=args.batch_size).to_dict()
-            seq = list(batch['seq'].values())
-            len_seq = list(batch['len_seq'].values())
-            target=list(batch['next'].values())
-
-            target_neg = []
-            for index in range(args.batch_size):
-                neg=np.random.randint(item_num)
-                while neg==target[index]:
-                    neg = np.random.randint(item_num)
-                target_neg.append(neg)
+        for j, batch in enumerate(train_loader):
+            seq = batch['seq']
+            len_seq = batch['len_seq']
+            target = batch['next']
+
+            target_neg = torch.randint(item_num, (args.batch_size, ), device=device)
+            collision = torch.eq(target_neg, target)
+            while collision.any():
+                target_neg[collision] = torch.randint(item_num, (int(collision.sum()), ), device=device)
+                collision = torch.eq(target_neg, target)
             optimizer.zero_grad()
-            seq = torch.LongTensor(seq)
-            len_seq = torch.LongTensor(len_seq)
-            target = torch.LongTensor(target)
-            target_neg = torch.LongTensor(target_neg)
-            seq = seq.to(device)
-            target = target.to(device)
-            len_seq = len_seq.to(device)
-            target_neg = target_neg.to(device)
 
-            model_output = model.forward(seq, len_seq)
+            with autocast(device, args.precision):
+                model_output = model.forward(seq, len_seq)
 
 
-            target = target.view(args.batch_size, 1)
-            target_neg = target_neg.view(args.batch_size, 1)
+                target = target.view(args.batch_size, 1)
+                target_neg = target_neg.view(args.batch_size, 1)
 
-            pos_scores = torch.gather(model_output, 1, target)
-            neg_scores = torch.gather(model_output, 1, target_neg)
+                pos_scores = torch.gather(model_output, 1, target)
+                neg_scores = torch.gather(model_output, 1, target_neg)
 
-            pos_labels = torch.ones((args.batch_size, 1))
-            neg_labels = torch.zeros((args.batch_size, 1))
+                pos_labels = torch.ones((args.batch_size, 1))
+                neg_labels = torch.zeros((args.batch_size, 1))
 
-            scores = torch.cat((pos_scores, neg_scores), 0)
-            labels = torch.cat((pos_labels, neg_labels), 0)
-            labels = labels.to(device)
+                scores = torch.cat((pos_scores, neg_scores), 0)
+                labels = torch.cat((pos_labels, neg_labels), 0)
+                labels = labels.to(device)
 
-            loss = bce_loss(scores, labels)
+                loss = bce_loss(scores, labels)
 
 
             loss_all = loss
-            loss_all.backward()
-            optimizer.step()
+            scaler.scale(loss_all).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             if True:
 
@@ -331,9 +300,9 @@ if __name__ == '__main__':
 
                 if total_step % 2000 == 0:
                     print('VAL PHRASE:')
-                    hr_20 = evaluate(model, 'val_data.df', device)
+                    hr_20 = evaluate(model, 'val_data', device)
                     print('TEST PHRASE:')
-                    _ = evaluate(model, 'test_data.df', device)
+                    _ = evaluate(model, 'test_data', device)
 
 
 
@@ -0,0 +1,267 @@
+import argparse
+import time as Time
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from Modules_ori import MultiHeadAttention
+from utility import TensorBatcher,extract_axis_1,calculate_hit,calculate_hit_tensor,ItemMatrix,ItemIndex,decoder_topk,SampledSoftmaxLoss
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the data pipeline and model kernels.")
+
+    parser.add_argument('--bench', type=str, default='batcher',
+                        help='batcher, extract_axis_1, calculate_hit, item_index, decoder_topk, decoder_loss, attention')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='rows of the synthetic training data.')
+    parser.add_argument('--seq_size', type=int, default=10,
+                        help='length of the synthetic sequences.')
+    parser.add_argument('--item_num', type=int, default=20000,
+                        help='items of the synthetic catalog.')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='Batch size.')
+    parser.add_argument('--hidden_factor', type=int, default=64,
+                        help='Number of hidden factors, i.e., embedding size.')
+    parser.add_argument('--steps', type=int, default=200,
+                        help='steps timed per variant.')
+    parser.add_argument('--random_seed', type=int, default=100,
+                        help='random seed')
+    return parser.parse_args()
+
+
+def synthetic_data(rows, seq_size, item_num):
+    return {
+        'seq': np.random.randint(0, item_num, (rows, seq_size)).astype(np.int32),
+        'len_seq': np.random.randint(1, seq_size + 1, rows).astype(np.int32),
+        'next': np.random.randint(0, item_num, rows).astype(np.int32),
+        'seq_genres': np.random.randint(1, 20, (rows, seq_size)).astype(np.int32),
+        'target_genre': np.random.randint(1, 20, rows).astype(np.int32),
+    }
+
+
+def timed(function, steps):
+    start = Time.time()
+    for _ in range(steps):
+        function()
+    return steps / (Time.time() - start)
+
+
+def bench_batcher(args):
+    # DataFrame.sample().to_dict() + LongTensor per step (the old training loops) against TensorBatcher
+    data = synthetic_data(args.rows, args.seq_size, args.item_num)
+    columns = list(data.keys())
+    train_data = pd.DataFrame({column: list(values) if values.ndim > 1 else values for column, values in data.items()})
+
+    def dataframe_step():
+        batch = train_data.sample(n=args.batch_size).to_dict()
+        return [torch.LongTensor(np.array(list(batch[column].values()))) for column in columns]
+
+    batcher = TensorBatcher(data, args.batch_size, columns=columns)
+    batches = iter(batcher)
+
+    def batcher_step():
+        nonlocal batches
+        try:
+            return next(batches)
+        except StopIteration:
+            batches = iter(batcher)
+            return next(batches)
+
+    dataframe_rate = timed(dataframe_step, args.steps)
+    batcher_rate = timed(batcher_step, args.steps)
+    print('{:<20s} {:>12s}'.format('loader', 'steps/sec'))
+    print('{:<20s} {:>12.1f}'.format('DataFrame.sample', dataframe_rate))
+    print('{:<20s} {:>12.1f}'.format('TensorBatcher', batcher_rate))
+    print('speedup: {:.1f}x'.format(batcher_rate / dataframe_rate))
+
+
+def extract_axis_1_loop(data, indices):
+    # the per-row loop extract_axis_1 replaced
+    res = []
+    for i in range(data.shape[0]):
+        res.append(data[i, indices[i], :])
+    res = torch.stack(res, dim=0).unsqueeze(1)
+    return res
+
+
+def bench_extract_axis_1(args):
+    # forward + backward of the per-row loop against the batched gather
+    print('{:<10s} {:>14s} {:>14s} {:>10s}'.format('batch', 'loop ms', 'gather ms', 'speedup'))
+    for batch_size in [256, 512, 1024, 2048, 4096]:
+        data = torch.randn(batch_size, args.seq_size, args.hidden_factor, requires_grad=True)
+        indices = np.random.randint(0, args.seq_size, batch_size)
+
+        for function in [extract_axis_1_loop, extract_axis_1]:
+            data.grad = None
+            function(data, indices).sum().backward()
+            if function is extract_axis_1_loop:
+                expected, expected_grad = function(data, indices), data.grad.clone()
+        assert torch.equal(extract_axis_1(data, indices), expected) and torch.equal(data.grad, expected_grad)
+
+        rates = [timed(lambda: function(data, indices).sum().backward(), args.steps) for function in [extract_axis_1_loop, extract_axis_1]]
+        print('{:<10d} {:>14.3f} {:>14.3f} {:>9.1f}x'.format(batch_size, 1000 / rates[0], 1000 / rates[1], rates[1] / rates[0]))
+
+
+def bench_calculate_hit(args):
+    # HR/NDCG@[5, 10, 20] of one evaluation batch with the per-row loop and with calculate_hit_tensor
+    topk = [5, 10, 20]
+    scores = torch.randn(args.batch_size, args.item_num)
+    target = np.random.randint(0, args.item_num, args.batch_size)
+    _, topK = scores.topk(max(topk), dim=1)
+    target[::2] = topK[::2, 3].numpy()
+
+    def loop_step():
+        sorted_list = np.flip(topK.numpy(), axis=1)
+        calculate_hit(sorted_list, topk, target, [0, 0, 0], [0, 0, 0])
+
+    def tensor_step():
+        calculate_hit_tensor(topK, topk, target, [0, 0, 0], [0, 0, 0])
+
+    hit, ndcg = [0, 0, 0], [0, 0, 0]
+    calculate_hit(np.flip(topK.numpy(), axis=1), topk, target, hit, ndcg)
+    hit_tensor, ndcg_tensor = [0, 0, 0], [0, 0, 0]
+    calculate_hit_tensor(topK, topk, target, hit_tensor, ndcg_tensor)
+    assert hit == hit_tensor and np.allclose(ndcg, ndcg_tensor), (hit, hit_tensor, ndcg, ndcg_tensor)
+
+    rates = [timed(loop_step, args.steps), timed(tensor_step, args.steps)]
+    print('{:<20s} {:>12s}'.format('metric', 'ms/batch'))
+    print('{:<20s} {:>12.3f}'.format('calculate_hit', 1000 / rates[0]))
+    print('{:<20s} {:>12.3f}'.format('calculate_hit_tensor', 1000 / rates[1]))
+    print('speedup: {:.1f}x'.format(rates[1] / rates[0]))
+
+
+def bench_item_index(args):
+    # top-10 of a batch of queries: full matmul + topk, the exact blocked index over fp32/fp16/int8 item matrices
+    # and the ivf index at several nprobe, recall@10 is measured against the full matmul
+    k = 10
+    embedding = torch.nn.Embedding(args.item_num, args.hidden_factor)
+    # clustered items, as trained embeddings are, so that the ivf lists are meaningful
+    centers = torch.randn(64, args.hidden_factor)
+    with torch.no_grad():
+        embedding.weight.copy_(centers[torch.randint(0, 64, (args.item_num, ))] + 0.5 * torch.randn(args.item_num, args.hidden_factor))
+    queries = embedding.weight[torch.randint(0, args.item_num, (args.batch_size, ))].detach() + 0.5 * torch.randn(args.batch_size, args.hidden_factor)
+    _, expected = torch.matmul(queries, embedding.weight.detach().T).topk(k, dim=1)
+
+    def recall(ids):
+        return torch.eq(ids[:, :, None], expected[:, None, :]).any(dim=2).float().mean().item()
+
+    matrix = ItemMatrix(embedding)
+    variants = [('full matmul', None), ('exact', ItemIndex(matrix, 'exact'))]
+    variants += [('exact ' + dtype, ItemIndex(ItemMatrix(embedding, dtype=dtype), 'exact')) for dtype in ['fp16', 'int8']]
+    variants += [('ivf nprobe={}'.format(nprobe), ItemIndex(matrix, 'ivf', nprobe=nprobe)) for nprobe in [1, 4, 16]]
+    print('{:<20s} {:>12s} {:>10s}'.format('index', 'ms/batch', 'recall@10'))
+    for name, index in variants:
+        if index is None:
+            function = lambda: torch.matmul(queries, embedding.weight.detach().T).topk(k, dim=1)
+        else:
+            index.refresh()
+            function = lambda: index.search(queries, k)
+        rate = timed(function, args.steps)
+        print('{:<20s} {:>12.3f} {:>10.3f}'.format(name, 1000 / rate, recall(function()[1])))
+
+
+def bench_decoder_topk(args):
+    # top-20 of the MovieTenc decoder: full logits + softmax + topk (the old evaluate) against decoder_topk
+    # at several block sizes; the last column is the largest score matrix alive, in MB
+    k = 20
+    decoder = torch.nn.Sequential(
+        torch.nn.Linear(args.hidden_factor, args.hidden_factor * 4),
+        torch.nn.ReLU(),
+        torch.nn.Linear(args.hidden_factor * 4, args.hidden_factor),
+        torch.nn.ReLU(),
+        torch.nn.Linear(args.hidden_factor, args.item_num),
+    )
+    x = torch.randn(args.batch_size, args.hidden_factor)
+
+    def full_step():
+        with torch.no_grad():
+            return F.softmax(decoder(x), dim=-1).topk(k, dim=1)
+
+    _, expected = full_step()
+    print('{:<20s} {:>12s} {:>12s}'.format('scorer', 'ms/batch', 'scores MB'))
+    print('{:<20s} {:>12.3f} {:>12.1f}'.format('softmax + topk', 1000 / timed(full_step, args.steps), args.batch_size * args.item_num * 4 / 2 ** 20))
+    for block_size in [1024, 4096, 16384]:
+        _, ids = decoder_topk(decoder, x, k, block_size)
+        assert torch.equal(ids, expected)
+        rate = timed(lambda: decoder_topk(decoder, x, k, block_size), args.steps)
+        print('{:<20s} {:>12.3f} {:>12.1f}'.format('blocked {}'.format(block_size), 1000 / rate, args.batch_size * (k + min(block_size, args.item_num)) * 4 / 2 ** 20))
+
+
+def bench_decoder_loss(args):
+    # forward + backward of the decoder output layer loss: full softmax cross entropy against sampled softmax
+    # (1000 negatives) and in-batch negatives, steps/sec as the catalog grows
+    print('{:<10s} {:>12s} {:>12s} {:>12s}'.format('items', 'full', 'sampled', 'inbatch'))
+    for item_num in [10000, 50000, 200000]:
+        output = torch.nn.Linear(args.hidden_factor, item_num)
+        hidden = torch.randn(args.batch_size, args.hidden_factor, requires_grad=True)
+        counts = np.random.zipf(1.5, item_num).clip(max=10000)
+        target = torch.multinomial(torch.as_tensor(counts, dtype=torch.float), args.batch_size, replacement=True)
+        losses = [lambda: F.cross_entropy(output(hidden), target)]
+        losses += [lambda loss=SampledSoftmaxLoss(counts, mode): loss(hidden, output, target) for mode in ['sampled', 'inbatch']]
+
+        def step(loss):
+            output.zero_grad(set_to_none=True)
+            loss().backward()
+
+        rates = [timed(lambda: step(loss), args.steps) for loss in losses]
+        print('{:<10d} {:>12.1f} {:>12.1f} {:>12.1f}'.format(item_num, *rates))
+
+
+def attention_inputs(batch_size, seq_len, hidden_factor):
+    # queries/keys as Tenc builds them: padded tails are zero, the last row is padded from the start
+    keys = torch.randn(batch_size, seq_len, hidden_factor)
+    lengths = torch.randint(1, seq_len + 1, (batch_size, ))
+    lengths[-1] = 0
+    keys = keys * torch.lt(torch.arange(seq_len)[None, :], lengths[:, None]).float().unsqueeze(-1)
+    return torch.nn.functional.layer_norm(keys, (hidden_factor, )), keys
+
+
+def bench_attention(args):
+    # MultiHeadAttention math backend against sdpa: parity of outputs and gradients, then forward and
+    # forward + backward time across sequence lengths
+    print('{:<8s} {:>12s} {:>12s} {:>14s} {:>14s}'.format('seq_len', 'math ms', 'sdpa ms', 'math fwd+bwd', 'sdpa fwd+bwd'))
+    for seq_len in [10, 20, 50, 100, 200]:
+        math = MultiHeadAttention(args.hidden_factor, args.hidden_factor, 2, 0.1).eval()
+        sdpa = MultiHeadAttention(args.hidden_factor, args.hidden_factor, 2, 0.1, backend='sdpa').eval()
+        sdpa.load_state_dict(math.state_dict())
+        queries, keys = attention_inputs(args.batch_size, seq_len, args.hidden_factor)
+
+        outputs, grads = [], []
+        for module in [math, sdpa]:
+            module.zero_grad()
+            output = module(queries, keys)
+            output.square().sum().backward()
+            outputs.append(output.detach())
+            grads.append([p.grad.clone() for p in module.parameters()])
+        assert torch.allclose(outputs[0], outputs[1], atol=1e-5), (outputs[0] - outputs[1]).abs().max()
+        assert all(torch.allclose(a, b, rtol=1e-4, atol=1e-3) for a, b in zip(*grads))
+
+        def forward(module):
+            with torch.no_grad():
+                module(queries, keys)
+
+        def backward(module):
+            module.zero_grad(set_to_none=True)
+            module(queries, keys).sum().backward()
+
+        rates = [timed(lambda: function(module), args.steps) for function in [forward, backward] for module in [math, sdpa]]
+        print('{:<8d} {:>12.3f} {:>12.3f} {:>14.3f} {:>14.3f}'.format(seq_len, *[1000 / rate for rate in rates]))
+
+
+BENCHMARKS = {
+    'batcher': bench_batcher,
+    'extract_axis_1': bench_extract_axis_1,
+    'calculate_hit': bench_calculate_hit,
+    'item_index': bench_item_index,
+    'decoder_topk': bench_decoder_topk,
+    'decoder_loss': bench_decoder_loss,
+    'attention': bench_attention,
+}
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    np.random.seed(args.random_seed)
+    torch.manual_seed(args.random_seed)
+    BENCHMARKS[args.bench](args)
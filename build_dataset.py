@@ -1,13 +1,50 @@
 import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time as Time
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+def map_shards(function, shards, workers, initializer=None, initargs=()):
+    # Results come back in shard order whatever the number of workers, so merging them is deterministic
+    if workers <= 1:
+        if initializer is not None: initializer(*initargs)
+        return list(map(function, shards))
+    
+    with multiprocessing.Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        return pool.map(function, shards)
+
+def user_windows(df_rating, history_size=11):
+    # The last history_size ratings of every user in chronological order (a stable sort keeps file order on ties)
+    df_rating = df_rating.sort_values(['userId', 'timestamp'], kind='mergesort')
+    return df_rating.groupby('userId', sort=False).tail(history_size)
+
+def to_timestamps(timestamp):
+    # int64 timestamps for the user state: unix times are kept, date strings become nanoseconds
+    if pd.api.types.is_numeric_dtype(timestamp):
+        return timestamp.to_numpy().astype(np.int64)
+    return pd.to_datetime(timestamp).to_numpy().astype('datetime64[ns]').astype(np.int64)
+
 class MoviesDataBuilder:
-    def __init__(self, rating_path='movie_dataset/rating.csv', meta_data_path='movie_dataset/movie.csv', number_of_users=None, output_path='movie_dataset/processed_dataset.csv'):
+    def __init__(self, rating_path='movie_dataset/rating.csv', meta_data_path='movie_dataset/movie.csv', number_of_users=None, output_path='movie_dataset/processed_dataset.csv', chunksize=None, df_rating=None, users=None):
         self.rating_path = rating_path
         self.meta_data_path = meta_data_path
         self.number_of_users = number_of_users
         self.output_path = output_path
+        self.chunksize = chunksize
+        
+        if df_rating is not None:
+            # A shard of ratings that were already loaded (see build_dataset_sharded)
+            self.df_rating = df_rating
+            self.users = users
+            return
+        
+        if self.chunksize is not None:
+            self.read_ratings_chunked()
+            return
         
         self.df_rating = pd.read_csv(self.rating_path)
         self.df_meta = pd.read_csv(self.meta_data_path)
@@ -16,16 +53,59 @@ class MoviesDataBuilder:
         
         self.users = self.df_rating.userId.unique()
         self.df_rating = self.df_rating[self.df_rating.rating >= 4.0]
+    
+    def read_ratings_chunked(self, history_size=11):
+        # Stream rating.csv in chunks of self.chunksize rows with only the needed columns and compact dtypes.
+        # Ratings are filtered before anything is joined, and only the last history_size liked movies of every
+        # user are kept between chunks, so peak memory is bounded by users * history_size + chunksize rows.
+        self.df_meta = pd.read_csv(self.meta_data_path, usecols=['movieId', 'genres'], dtype={'movieId': 'int32', 'genres': 'category'})
+        movie_ids = self.df_meta.movieId.to_numpy()
+        
+        users = []
+        df_rating = None
+        chunks = pd.read_csv(self.rating_path, usecols=['userId', 'movieId', 'rating', 'timestamp'], chunksize=self.chunksize,
+                             dtype={'userId': 'int32', 'movieId': 'int32', 'rating': 'float32'})
+        for chunk in tqdm(chunks, desc='Reading ratings'):
+            chunk = chunk[chunk.movieId.isin(movie_ids)]
+            users.append(chunk.userId.unique())
+            
+            chunk = chunk[chunk.rating >= 4.0].drop(columns='rating')
+            if not pd.api.types.is_numeric_dtype(chunk.timestamp):
+                chunk['timestamp'] = pd.to_datetime(chunk.timestamp)
+            
+            df_rating = chunk if df_rating is None else pd.concat([df_rating, chunk], ignore_index=True)
+            df_rating = user_windows(df_rating, history_size)
+        
+        self.users = pd.unique(np.concatenate(users))
+        
+        # Genres are joined by movieId only for the kept rows
+        self.df_rating = pd.merge(df_rating, self.df_meta, on='movieId', how='left')
         
     def build_user(self):
-        # Build users' preference
+        # Build users' preference with one sort and a groupby instead of a scan per user
+        if self.number_of_users is not None: self.users = self.users[:self.number_of_users]
+        
+        df = user_windows(self.df_rating[self.df_rating.userId.isin(self.users)])
+        
+        users_pref = df.groupby('userId', sort=False).movieId.agg(lambda movies: movies.tolist()).to_dict()
+        
+        # The last item is the target, so the genres must not include its genre to prevent data leak
+        history = df[df.userId.duplicated(keep='last')]
+        genres = history.genres.str.replace('|', ',', regex=False)
+        movies_genres = genres.groupby(history.userId, sort=False).agg('|'.join).to_dict()
+        
+        self.users_pref = [users_pref.get(user, []) for user in self.users]
+        self.movies_genres = [movies_genres.get(user, "") for user in self.users]
+    
+    def build_user_loop(self):
+        # Build users' preference (one scan of df_rating per user, kept as a reference for build_user)
         self.users_pref = []
         self.movies_genres = []
         
         if self.number_of_users is not None: self.users = self.users[:self.number_of_users]
         
         for user in tqdm(self.users[:self.number_of_users], desc='Building user preferences'):
-            userData = self.df_rating[self.df_rating.userId == user].sort_values('timestamp')[-11:]
+            userData = self.df_rating[self.df_rating.userId == user].sort_values('timestamp', kind='mergesort')[-11:]
             self.users_pref.append(userData.movieId.to_list())
             
             # The last item is the target, so the genres must not include its genre to prevent data leak
@@ -65,12 +145,166 @@ class MoviesDataBuilder:
                                     'genres': meta_data
                                 })
         
+        if self.output_path is not None:
+            self.dataset.to_csv(self.output_path, index=False)
+    
+    def build_dataset_sharded(self, workers, shard_size=10000, max_length_size=10):
+        # Users are split into shards of shard_size consecutive users, each built by build_user/build_dataset
+        # in a process pool, and the shards are concatenated back in user order
+        users = self.users if self.number_of_users is None else self.users[:self.number_of_users]
+        shard_of_user = pd.Series(np.arange(len(users)) // shard_size, index=users)
+        frames = dict(tuple(self.df_rating.groupby(self.df_rating.userId.map(shard_of_user))))
+        
+        shards = []
+        for index, start in enumerate(range(0, len(users), shard_size)):
+            df_rating = frames.get(index, self.df_rating.iloc[:0])
+            shards.append((df_rating, users[start:start+shard_size], max_length_size))
+        
+        datasets = map_shards(build_dataset_shard, shards, workers)
+        self.dataset = pd.concat(datasets, ignore_index=True)
         self.dataset.to_csv(self.output_path, index=False)
 
+    def save_state(self, state_path, history_size=11):
+        # Save the per-user state that IncrementalDataBuilder updates instead of rebuilding the dataset
+        users = self.users if self.number_of_users is None else self.users[:self.number_of_users]
+        windows = user_windows(self.df_rating[self.df_rating.userId.isin(users)], history_size)
+        
+        state = UserState(users, history_size)
+        state.set_windows(np.arange(len(users)), windows)
+        
+        # build_dataset keeps the users with at least two movies, in user order
+        kept = state.counts >= 2
+        state.rows[kept] = np.arange(kept.sum())
+        state.save(state_path)
+
+def build_dataset_shard(shard):
+    df_rating, users, max_length_size = shard
+    data_builder = MoviesDataBuilder(df_rating=df_rating, users=users, output_path=None)
+    data_builder.build_user()
+    data_builder.build_dataset(max_length_size)
+    return data_builder.dataset
+
+class UserState:
+    # Last liked movies of every user (oldest first, padded with -1), their timestamps and
+    # the row of the user in the processed dataset (-1 when the user has fewer than two movies)
+    def __init__(self, users, history_size=11):
+        self.users = np.asarray(users, dtype=np.int64)
+        self.movies = np.full((len(users), history_size), -1, dtype=np.int32)
+        self.timestamps = np.zeros((len(users), history_size), dtype=np.int64)
+        self.counts = np.zeros(len(users), dtype=np.int64)
+        self.rows = np.full(len(users), -1, dtype=np.int64)
+    
+    @classmethod
+    def load(cls, state_path):
+        arrays = np.load(state_path)
+        state = cls(arrays['users'], arrays['movies'].shape[1])
+        state.movies, state.timestamps, state.counts, state.rows = arrays['movies'], arrays['timestamps'], arrays['counts'], arrays['rows']
+        return state
+    
+    def save(self, state_path):
+        with open(state_path, 'wb') as file:
+            np.savez(file, users=self.users, movies=self.movies, timestamps=self.timestamps, counts=self.counts, rows=self.rows)
+    
+    def add_users(self, users):
+        state = UserState(users, self.movies.shape[1])
+        self.users = np.concatenate([self.users, state.users])
+        self.movies = np.concatenate([self.movies, state.movies])
+        self.timestamps = np.concatenate([self.timestamps, state.timestamps])
+        self.counts = np.concatenate([self.counts, state.counts])
+        self.rows = np.concatenate([self.rows, state.rows])
+    
+    def get_windows(self, positions):
+        # Long (userId, movieId, timestamp) frame of the windows of the users at positions
+        counts = self.counts[positions]
+        kept = np.arange(self.movies.shape[1]) < counts[:, None]
+        return pd.DataFrame({
+                            'userId': np.repeat(self.users[positions], counts),
+                            'movieId': self.movies[positions][kept],
+                            'timestamp': self.timestamps[positions][kept],
+                        })
+    
+    def set_windows(self, positions, windows):
+        # windows must come from user_windows, i.e. be sorted by (userId, timestamp)
+        position_of_user = pd.Series(positions, index=self.users[positions])
+        window_positions = position_of_user[windows.userId.to_numpy()].to_numpy()
+        ranks = windows.groupby('userId', sort=False).cumcount().to_numpy()
+        
+        self.movies[positions] = -1
+        self.timestamps[positions] = 0
+        self.movies[window_positions, ranks] = windows.movieId.to_numpy()
+        self.timestamps[window_positions, ranks] = to_timestamps(windows.timestamp)
+        self.counts[positions] = np.bincount(window_positions, minlength=len(self.users))[positions]
+
+class IncrementalDataBuilder:
+    def __init__(self, delta_path, state_path, meta_data_path='movie_dataset/movie.csv', output_path='movie_dataset/processed_dataset.csv', seed=0):
+        # Apply a delta ratings file to the processed dataset: only the users of the delta are rebuilt,
+        # from their saved windows (see MoviesDataBuilder.save_state) and their new ratings
+        state = UserState.load(state_path)
+        df_meta = pd.read_csv(meta_data_path, usecols=['movieId', 'genres'])
+        
+        delta = pd.read_csv(delta_path, usecols=['userId', 'movieId', 'rating', 'timestamp'])
+        delta = delta[delta.movieId.isin(df_meta.movieId)]
+        
+        # Users seen for the first time get an empty window, as in a full build
+        state.add_users(pd.unique(delta.userId[~delta.userId.isin(state.users)]))
+        position_of_user = pd.Series(np.arange(len(state.users)), index=state.users)
+        
+        delta = delta[delta.rating >= 4.0].drop(columns='rating')
+        delta['timestamp'] = to_timestamps(delta.timestamp)
+        users = pd.unique(delta.userId)
+        positions = position_of_user[users].to_numpy()
+        
+        windows = pd.concat([state.get_windows(positions), delta], ignore_index=True)
+        windows = user_windows(windows, state.movies.shape[1])
+        state.set_windows(positions, windows)
+        
+        data_builder = MoviesDataBuilder(df_rating=pd.merge(windows, df_meta, on='movieId', how='left'), users=users, output_path=None)
+        data_builder.build_user()
+        data_builder.build_dataset()
+        rows = data_builder.dataset
+        rows['seq'] = rows.seq.map(str)
+        
+        # Users already in the dataset are updated in place, the others are appended
+        kept = positions[[len(movies_set) >= 2 for movies_set in data_builder.users_pref]]
+        existing = state.rows[kept] >= 0
+        
+        # Datasets that went through --user_genres keep their encoded genres: only the rebuilt rows are
+        # encoded, with the genre ids of genres.csv (genres not seen yet get the next ids)
+        columns = pd.read_csv(output_path, nrows=0).columns
+        index = columns[0] if columns[0].startswith('Unnamed') else None
+        if 'seq_genres' in columns:
+            genres_builder = GenresDataBuilder.from_genres_file(genres_file(output_path), meta_data_path, rows.genres, rows.target)
+            rng = random.Random(seed)
+            encoded = [genres_builder.encode_genres(genres, target, rng) for genres, target in zip(rows.genres, rows.target)]
+            rows['seq_genres'] = [seq_genres for seq_genres, _ in encoded]
+            rows['target_genre'] = [target_genre for _, target_genre in encoded]
+        rows = rows[columns.drop(index) if index is not None else columns]
+        
+        # The CSV is streamed line by line (no field holds a newline): untouched rows are copied as they are,
+        # without being parsed, and only the rebuilt rows are formatted
+        updated = rows[existing].set_axis(state.rows[kept[existing]])
+        updated_lines = dict(zip(updated.index, updated.to_csv(header=False, index=index is not None).splitlines(keepends=True)))
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(output_path)), delete=False) as file, open(output_path) as dataset:
+            file.write(dataset.readline())
+            num_rows = 0
+            for num_rows, line in enumerate(dataset, 1):
+                file.write(updated_lines.get(num_rows - 1, line))
+            
+            state.rows[kept[~existing]] = np.arange(num_rows, num_rows + (~existing).sum())
+            appended = rows[~existing].set_axis(state.rows[kept[~existing]])
+            file.write(appended.to_csv(header=False, index=index is not None))
+        os.replace(file.name, output_path)
+        state.save(state_path)
+        self.rows = rows
+
+def genres_file(processed_data_file):
+    # genres.csv written by GenresDataBuilder next to the processed dataset
+    return '/'.join(processed_data_file.split('/')[:-1])+'genres.csv'
+
 class GenresDataBuilder:
-    def __init__(self, processed_data_file='movie_dataset/processed_dataset.csv', movie_meta_data_path='movie_dataset/movie.csv'):
+    def __init__(self, processed_data_file='movie_dataset/processed_dataset.csv', movie_meta_data_path='movie_dataset/movie.csv', workers=None, seed=0, shard_size=10000):
         df = pd.read_csv(processed_data_file)
-        genres_output = '/'.join(processed_data_file.split('/')[:-1])+'genres.csv'
+        genres_output = genres_file(processed_data_file)
         genres_set = set()
         for row in df.to_numpy():
             genres = row[3]
@@ -78,52 +312,161 @@ class GenresDataBuilder:
                 for genre in sub_genre.split(','):
                     genres_set.add(genre)
 
-        genres_list = list(genres_set)
+        # Sorted so that genre ids do not depend on the hash seed of the process
+        genres_list = sorted(genres_set)
         genres_id = list(zip(range(1, len(genres_list)+1), genres_list))
         self.genres_meta_data = pd.DataFrame(genres_id, columns=['genre_id', 'genre'])
         self.genres_meta_data.to_csv(genres_output, index=False)
-        self.movie_meta_data = pd.read_csv(movie_meta_data_path)
+        self.set_lookups(movie_meta_data_path)
         
-        df = df.apply(self.encode_genres, axis=1)
+        # Every shard of shard_size rows draws from its own RNG seeded with seed + shard index,
+        # so the encoding is reproducible whatever the number of workers, including none
+        shards = []
+        for index, start in enumerate(range(0, len(df), shard_size)):
+            shards.append((seed + index, df.genres[start:start+shard_size].tolist(), df.target[start:start+shard_size].tolist()))
+        encoded = map_shards(encode_genres_shard, shards, workers or 1, initializer=set_genres_builder, initargs=(self,))
+        encoded = [row for shard in encoded for row in shard]
+        df['seq_genres'] = [seq_genres for seq_genres, _ in encoded]
+        df['target_genre'] = [target_genre for _, target_genre in encoded]
         df.to_csv(processed_data_file)
         
-    def encode_genres(self, row):
-        genres = row['genres']
+    def set_lookups(self, movie_meta_data_path):
+        self.movie_meta_data = pd.read_csv(movie_meta_data_path)
+        
+        # Lookup tables replacing the DataFrame filters: genre -> genre_id, movieId -> genres
+        self.genre_ids = dict(zip(self.genres_meta_data.genre, self.genres_meta_data.genre_id.tolist()))
+        self.movie_genres = dict(zip(self.movie_meta_data.movieId, self.movie_meta_data.genres.str.split('|')))
+        self.sub_genre_ids = {}
+    
+    @classmethod
+    def from_genres_file(cls, genres_path, movie_meta_data_path, genres, targets):
+        # Encoder for new rows of an already encoded dataset: the ids of genres.csv are kept, and the genres
+        # of genres/targets that it does not list yet are added after them
+        builder = cls.__new__(cls)
+        builder.genres_meta_data = pd.read_csv(genres_path)
+        builder.set_lookups(movie_meta_data_path)
+        
+        genres_set = {genre for row in genres for sub_genre in row.split('|') for genre in sub_genre.split(',')}
+        genres_set.update(genre for target in targets for genre in builder.movie_genres[target])
+        new_genres = sorted(genres_set.difference(builder.genre_ids))
+        if new_genres:
+            start = builder.genres_meta_data.genre_id.max() + 1
+            new_genres = pd.DataFrame({'genre_id': range(start, start + len(new_genres)), 'genre': new_genres})
+            builder.genres_meta_data = pd.concat([builder.genres_meta_data, new_genres], ignore_index=True)
+            builder.genres_meta_data.to_csv(genres_path, index=False)
+            builder.genre_ids.update(zip(new_genres.genre, new_genres.genre_id.tolist()))
+        return builder
+    
+    def encode_genres(self, genres, target, rng=random):
         genres_list = list()
         for sub_genre in genres.split('|'):
-            genre = random.choice(sub_genre.split(','))
-            genre_id = self.genres_meta_data[self.genres_meta_data.genre == genre].genre_id.values[0]
-            genres_list.append(int(genre_id))
+            sub_genre_ids = self.sub_genre_ids.get(sub_genre)
+            if sub_genre_ids is None:
+                sub_genre_ids = self.sub_genre_ids[sub_genre] = [self.genre_ids[genre] for genre in sub_genre.split(',')]
+            genres_list.append(rng.choice(sub_genre_ids))
         
         while len(genres_list) < 10:
             genres_list.append(genres_list[-1])
         
-        row['seq_genres'] = genres_list
-        target_genres = self.movie_meta_data[self.movie_meta_data.movieId==row.target].genres.values[0].split('|')
-        target_genre = random.choice(target_genres)
-        target_genre_id = self.genres_meta_data[self.genres_meta_data.genre == target_genre].genre_id.values[0]
-        row['target_genre'] = target_genre_id
-        return row
+        target_genre = rng.choice(self.movie_genres[target])
+        target_genre_id = self.genre_ids[target_genre]
+        return genres_list, target_genre_id
+
+genres_builder = None
+
+def set_genres_builder(builder):
+    global genres_builder
+    genres_builder = builder
+
+def encode_genres_shard(shard):
+    seed, genres, targets = shard
+    rng = random.Random(seed)
+    return [genres_builder.encode_genres(genres_row, target, rng) for genres_row, target in zip(genres, targets)]
         
 
+def benchmark_build_user(num_users=2000, num_movies=5000, ratings_per_user=100, seed=0):
+    """
+    Compare MoviesDataBuilder.build_user against the per-user loop on a synthetic ratings file.
+    """
+    rng = np.random.default_rng(seed)
+    genres = np.array(['Action', 'Comedy', 'Drama', 'Horror', 'Romance', 'Thriller', 'Sci-Fi', 'Animation'])
+    movies = pd.DataFrame({
+                        'movieId': np.arange(1, num_movies+1),
+                        'title': [f'Movie {i}' for i in range(1, num_movies+1)],
+                        'genres': ['|'.join(rng.choice(genres, size=rng.integers(1, 4), replace=False)) for _ in range(num_movies)],
+                    })
+    num_ratings = num_users * ratings_per_user
+    ratings = pd.DataFrame({
+                        'userId': rng.integers(1, num_users+1, size=num_ratings),
+                        'movieId': rng.integers(1, num_movies+1, size=num_ratings),
+                        'rating': rng.integers(1, 11, size=num_ratings) / 2,
+                        'timestamp': rng.permutation(num_ratings),
+                    })
+    
+    with tempfile.TemporaryDirectory() as directory:
+        rating_path = os.path.join(directory, 'rating.csv')
+        meta_data_path = os.path.join(directory, 'movie.csv')
+        ratings.to_csv(rating_path, index=False)
+        movies.to_csv(meta_data_path, index=False)
+        
+        data_builder = MoviesDataBuilder(rating_path=rating_path, meta_data_path=meta_data_path)
+        start = Time.time()
+        data_builder.build_user_loop()
+        loop_time = Time.time() - start
+        loop_output = (data_builder.users_pref, data_builder.movies_genres)
+        
+        start = Time.time()
+        data_builder.build_user()
+        vectorized_time = Time.time() - start
+        
+    assert loop_output == (data_builder.users_pref, data_builder.movies_genres), "build_user and build_user_loop disagree"
+    print(f"{num_ratings} ratings, {len(data_builder.users)} users", flush=True)
+    print(f"loop: {loop_time:.3f}s  vectorized: {vectorized_time:.3f}s  speedup: {loop_time / vectorized_time:.1f}x", flush=True)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Choose what you want to generate: the initial dataset or the genres dataset.")
     parser.add_argument('--user_movie', action='store_true', default=False)
     parser.add_argument('--rating_file', default='movie_dataset/rating.csv')
     parser.add_argument('--metadata_file', default='movie_dataset/movie.csv')
     parser.add_argument('-o', '--output', default='movie_dataset/processed_dataset.csv')
-    parser.add_argument('--users', default=None)
+    parser.add_argument('--users', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=None, help='stream rating.csv in chunks of this many rows to bound peak memory')
+    parser.add_argument('--workers', type=int, default=None, help='build the dataset in shards with a pool of this many processes')
+    parser.add_argument('--shard_size', type=int, default=10000, help='users (or rows for the genres) per shard')
+    parser.add_argument('--seed', type=int, default=0, help='base seed of the per-shard genre RNGs')
+    parser.add_argument('--state', default=None, help='per-user state file, saved by --user_movie and updated by --delta')
+    parser.add_argument('--delta', default=None, help='ratings to add to the dataset without a full rebuild (needs --state; the encoded genres of the rebuilt rows are drawn with --seed)')
     
     parser.add_argument('--user_genres', action='store_true', default=False)
-    
+    parser.add_argument('--benchmark', action='store_true', default=False, help='compare build_user with the per-user loop on synthetic ratings')
+    parser.add_argument('--columnar', default=None, help='data directory whose pickled train/val/test DataFrames are exported to the columnar .npy layout that load_data memory-maps')
     
     args = parser.parse_args()
+    if args.delta and args.state is None:
+        parser.error('--delta needs the --state file saved by --user_movie')
+    if args.benchmark:
+        benchmark_build_user()
     if args.user_movie:
-        assert False, args.user_movie
-        data_builder = MoviesDataBuilder(rating_path=args.rating_file, meta_data_path=args.metadata_file, number_of_users=args.users, output_path=args.output)
-        data_builder.build_user()
-        data_builder.build_dataset()
+        data_builder = MoviesDataBuilder(rating_path=args.rating_file, meta_data_path=args.metadata_file, number_of_users=args.users, output_path=args.output, chunksize=args.chunksize)
+        if args.workers is None:
+            data_builder.build_user()
+            data_builder.build_dataset()
+        else:
+            data_builder.build_dataset_sharded(args.workers, shard_size=args.shard_size)
+        if args.state is not None:
+            data_builder.save_state(args.state)
         print(f"The initial dataset has been created!: {args.output}", flush=True)
+    if args.delta:
+        IncrementalDataBuilder(delta_path=args.delta, state_path=args.state, meta_data_path=args.metadata_file, output_path=args.output, seed=args.seed)
+        print(f"The new ratings were added to the dataset!: {args.output}", flush=True)
     if args.user_genres:
-        GenresDataBuilder(processed_data_file=args.output, movie_meta_data_path=args.metadata_file)
-        print(f"The genres sequences were added to the dataset!: {args.output}", flush=True)
\ No newline at end of file
+        GenresDataBuilder(processed_data_file=args.output, movie_meta_data_path=args.metadata_file, workers=args.workers, seed=args.seed, shard_size=args.shard_size)
+        print(f"The genres sequences were added to the dataset!: {args.output}", flush=True)
+    if args.columnar:
+        from utility import to_columnar
+        splits = {}
+        for name in ['train_data', 'val_data', 'test_data']:
+            if os.path.exists(os.path.join(args.columnar, name + '.df')):
+                splits[name] = pd.read_pickle(os.path.join(args.columnar, name + '.df'))
+        to_columnar(args.columnar, **splits)
+        print(f"The columnar data has been written!: {', '.join(os.path.join(args.columnar, name) for name in splits)}", flush=True)
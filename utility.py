@@ -1,6 +1,12 @@
 import os
+import contextlib
 import copy
+import json
+import logging
 import math
+import queue
+import threading
+import time as Time
 import numpy as np
 import pandas as pd
 from collections import deque
@@ -11,17 +17,592 @@ import torch.nn.functional as F
 
 
 def extract_axis_1(data, indices):
-    res = []
-    for i in range(data.shape[0]):
-        res.append(data[i, indices[i], :])
-    res = torch.stack(res, dim=0).unsqueeze(1)
+    # data[i, indices[i], :] for every row i in one advanced-indexing gather, shape (B, 1, D);
+    # indices may be a tensor or a numpy array
+    indices = torch.as_tensor(indices, device=data.device).long()
+    res = data[torch.arange(data.shape[0], device=data.device), indices].unsqueeze(1)
     return res
 
 
+def weights_version(module):
+    # changes whenever a parameter of module is moved, replaced or updated in place,
+    # e.g. by optimizer.step() or load_state_dict(); keys caches of values derived from the weights
+    return tuple((parameter.data_ptr(), parameter._version) for parameter in module.parameters())
+
+def weights_storage(module):
+    # changes only when a parameter of module is moved or replaced, not when it is updated in place;
+    # keys values that read the weights live, such as a captured CUDA graph
+    return tuple(parameter.data_ptr() for parameter in module.parameters())
+
+
+PRECISIONS = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def autocast(device, precision='fp32'):
+    # torch.autocast for --precision: matmuls and convolutions in bf16/fp16 while the weights, the diffusion
+    # schedule buffers and reductions stay fp32; fp32 is a no-op context
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=PRECISIONS[precision])
+
+
 def to_pickled_df(data_directory, **kwargs):
     for name, df in kwargs.items():
         df.to_pickle(os.path.join(data_directory, name + '.df'))
 
+COLUMNS = ('seq', 'len_seq', 'next', 'target', 'seq_genres', 'target_genre')
+
+def to_columnar(data_directory, columns=COLUMNS, **kwargs):
+    # Every DataFrame is saved as a directory with one fixed-width int32 .npy file per column,
+    # e.g. train_data/seq.npy of shape (rows, seq_size) and train_data/len_seq.npy of shape (rows,)
+    for name, df in kwargs.items():
+        directory = os.path.join(data_directory, name)
+        os.makedirs(directory, exist_ok=True)
+        for column in columns:
+            if column not in df.columns:
+                continue
+            values = df[column].tolist()
+            if len(values) and isinstance(values[0], str):
+                # list columns read back from a csv
+                values = [json.loads(value) for value in values]
+            np.save(os.path.join(directory, column + '.npy'), np.asarray(values).astype(np.int32))
+
+def read_columnar(data_directory, name, mmap_mode='c'):
+    # Columns are memory-mapped copy-on-write, so torch.from_numpy can wrap slices of them without a copy
+    directory = os.path.join(data_directory, name)
+    data = {}
+    for file in sorted(os.listdir(directory)):
+        if file.endswith('.npy'):
+            data[file[:-len('.npy')]] = np.load(os.path.join(directory, file), mmap_mode=mmap_mode)
+    return data
+
+def load_data(data_directory, name, columns=COLUMNS):
+    # Read the columnar directory written by to_columnar if there is one, otherwise the pickled DataFrame
+    if os.path.isdir(os.path.join(data_directory, name)):
+        return read_columnar(data_directory, name)
+    df = pd.read_pickle(os.path.join(data_directory, name + '.df'))
+    return {column: np.asarray(df[column].tolist()).astype(np.int32) for column in columns if column in df.columns}
+
+class TensorBatcher():
+    """
+    Serves training batches from columns converted once to contiguous int64 tensors.
+    Every epoch draws a permutation of the rows and each batch is gathered with index_select,
+    instead of DataFrame.sample().to_dict() and a LongTensor built from Python lists per step.
+    :param data: dict of numpy arrays, e.g. from load_data.
+    :param batch_size: rows per batch; the last incomplete batch of an epoch is dropped.
+    :param columns: columns of data to serve.
+    :param shuffle: draw a new permutation every epoch, otherwise serve rows in order.
+    :param pin_memory: gather batches into pinned memory so that the copy to device is asynchronous.
+    :param device: device the batches are moved to.
+    :param num_shards: data parallel ranks, each serves an equal disjoint share of the rows every epoch.
+    :param shard: rank of this batcher.
+    :param seed: seed of the permutation shared by the shards, drawn per epoch from seed + epoch.
+    """
+    def __init__(self, data, batch_size, columns=('seq', 'len_seq', 'next'), shuffle=True, pin_memory=False, device=None,
+                 num_shards=1, shard=0, seed=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.device = device
+        self.tensors = {column: torch.from_numpy(np.ascontiguousarray(data[column])).long() for column in columns}
+        self.num_rows = len(next(iter(self.tensors.values())))
+        self.num_shards = num_shards
+        self.shard = shard
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return self.num_rows // self.num_shards // self.batch_size
+
+    def __iter__(self):
+        if self.num_shards > 1:
+            # every shard draws the same permutation and keeps its own stride of it, truncated to the same length
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            self.epoch += 1
+            order = torch.randperm(self.num_rows, generator=generator) if self.shuffle else torch.arange(self.num_rows)
+            order = order[self.shard::self.num_shards][:self.num_rows // self.num_shards]
+        else:
+            order = torch.randperm(self.num_rows) if self.shuffle else torch.arange(self.num_rows)
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            yield self.gather(order[start:start + self.batch_size])
+
+    def gather(self, index):
+        batch = {}
+        for column, tensor in self.tensors.items():
+            values = tensor.index_select(0, index)
+            if self.pin_memory:
+                values = values.pin_memory()
+            if self.device is not None:
+                values = values.to(self.device, non_blocking=self.pin_memory)
+            batch[column] = values
+        return batch
+
+
+def broadcast_module(module, src=0):
+    # copies the parameters and buffers of rank src into module on every rank of the default process group
+    for tensor in module.state_dict().values():
+        torch.distributed.broadcast(tensor, src)
+
+
+def all_reduce_gradients(module):
+    # averages the gradients of module over the ranks of the default process group in one flattened all_reduce;
+    # only the parameters that took part in the graph, i.e. have a gradient, are reduced, which is the same set
+    # on every rank since all ranks run the same forward
+    parameters = [parameter for parameter in module.parameters() if parameter.grad is not None]
+    if not parameters:
+        return
+    flat = torch.cat([parameter.grad.reshape(-1) for parameter in parameters])
+    torch.distributed.all_reduce(flat)
+    flat /= torch.distributed.get_world_size()
+    offset = 0
+    for parameter in parameters:
+        parameter.grad.copy_(flat[offset:offset + parameter.numel()].view_as(parameter))
+        offset += parameter.numel()
+
+
+class Prefetcher():
+    """
+    Prepares the next batches of an iterable in a background thread while the model trains on the current one.
+    On CUDA the batches are produced on a side stream so their host to device copies overlap with compute.
+    :param batches: iterable of dicts of tensors, e.g. a TensorBatcher.
+    :param depth: number of batches prepared ahead.
+    :param device: device of the batches.
+    wait_time accumulates the seconds the training loop stalled waiting for a batch.
+    """
+    def __init__(self, batches, depth=2, device=None):
+        self.batches = batches
+        self.depth = depth
+        self.stream = torch.cuda.Stream(device) if device is not None and torch.device(device).type == 'cuda' else None
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def produce(self, buffer, stop):
+        def put(item):
+            # gives up when the training loop stopped consuming
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            with torch.cuda.stream(self.stream):
+                for batch in self.batches:
+                    event = None
+                    if self.stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    if not put((batch, event)):
+                        return
+            put((None, None))
+        except Exception as error:
+            put((error, None))
+
+    def __iter__(self):
+        buffer = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(buffer, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = Time.time()
+                batch, event = buffer.get()
+                self.wait_time += Time.time() - start
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    torch.cuda.current_stream().wait_event(event)
+                    for tensor in batch.values():
+                        tensor.record_stream(torch.cuda.current_stream())
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+class CompiledSampler():
+    """
+    The reverse loop of diffusion.sample for one batch shape, traced once and then replayed.
+    On CUDA the whole loop is captured into a CUDA graph, elsewhere it goes through torch.compile,
+    and when neither works it runs eagerly. The noise is drawn eagerly, in the order the eager
+    sampler draws it, so both samplers return the same samples under the same seed.
+    The traced loop reads the parameters live, so in-place updates (optimizer.step(), load_state_dict)
+    need no retrace; only moving or replacing the parameters does, see weights_storage.
+    :param diff: diffusion whose sampler settings (ddpm/ddim, steps, eta) are traced.
+    :param model_forward: denoiser forward, fused with guidance when model_forward_uncon is None.
+    :param model_forward_uncon: unconditional forward or None.
+    :param h: conditioning of the traced batch shape; cond are the extra conditioning tensors.
+    """
+    def __init__(self, diff, model_forward, model_forward_uncon, h, *cond):
+        self.diff = diff
+        self.model_forward = model_forward
+        self.model_forward_uncon = model_forward_uncon
+        self.storage = weights_storage(model_forward.__self__)
+        self.sampler = diff.sampler
+        if self.sampler == 'ddim':
+            self.timesteps = diff.ddim_timesteps()
+            # host copy read at trace time, index -1 (after the last step) is alpha_cumprod = 1
+            self.alphas_cumprod = diff.alphas_cumprod.tolist() + [1.0]
+        self.graph = None
+        self.mode = 'eager'
+        # traced on zeros, so building a sampler leaves the random state alone
+        x, noise = torch.zeros_like(h), h.new_zeros((self.noise_steps(), ) + tuple(h.shape))
+        if h.is_cuda:
+            try:
+                self.capture(x, h, noise, cond)
+                self.mode = 'cuda_graph'
+                return
+            except Exception as error:
+                logging.warning('CUDA graph capture of the sampler failed, trying torch.compile: %s', error)
+        try:
+            compiled = torch.compile(self.loop, dynamic=False)
+            compiled(x, h, noise, *cond)
+            self.run = compiled
+            self.mode = 'compile'
+        except Exception as error:
+            logging.warning('torch.compile of the sampler failed, sampling eagerly: %s', error)
+
+    def noise_steps(self):
+        # steps that add noise, all but the last one unless ddim is deterministic
+        if self.sampler == 'ddim':
+            return len(self.timesteps) - 1 if self.diff.eta > 0 else 0
+        return self.diff.timesteps - 1
+
+    def draw_noise(self, h):
+        # the noise the eager sampler draws after its initial x, one row per step that adds noise
+        if self.noise_steps() == 0:
+            return h.new_empty((0, ) + tuple(h.shape))
+        return torch.stack([torch.randn_like(h) for _ in range(self.noise_steps())])
+
+    def loop(self, x, h, noise, *cond):
+        diff = self.diff
+        batch_size = h.shape[0]
+        if self.sampler == 'ddim':
+            for i, (n, n_prev) in enumerate(zip(self.timesteps, self.timesteps[1:] + [-1])):
+                t = torch.full((batch_size, ), n, device=h.device, dtype=torch.long)
+                x = diff.p_sample_ddim(self.model_forward, self.model_forward_uncon, x, h, t, self.alphas_cumprod[n], self.alphas_cumprod[n_prev],
+                                       *cond, noise=noise[i] if i < len(noise) else None)
+            return x
+        for i, n in enumerate(reversed(range(0, diff.timesteps))):
+            t = torch.full((batch_size, ), n, device=h.device, dtype=torch.long)
+            x = diff.p_sample(self.model_forward, self.model_forward_uncon, x, h, t, n, *cond, noise=noise[i] if i < len(noise) else None)
+        return x
+
+    def run(self, x, h, noise, *cond):
+        return self.loop(x, h, noise, *cond)
+
+    def capture(self, x, h, noise, cond):
+        self.static_inputs = [x.clone(), h.clone(), noise.clone()] + [c.clone() for c in cond]
+        # warm up on a side stream (this also builds lazily cached tables) before capturing
+        stream = torch.cuda.Stream(h.device)
+        stream.wait_stream(torch.cuda.current_stream(h.device))
+        with torch.cuda.stream(stream):
+            self.loop(*self.static_inputs)
+        torch.cuda.current_stream(h.device).wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            self.static_output = self.loop(*self.static_inputs)
+        self.graph = graph
+
+    def matches(self, diff, model_forward, model_forward_uncon):
+        return self.diff is diff and self.model_forward == model_forward and self.model_forward_uncon == model_forward_uncon and \
+            self.storage == weights_storage(model_forward.__self__)
+
+    @torch.no_grad()
+    def sample(self, h, *cond):
+        x, noise = torch.randn_like(h), self.draw_noise(h)
+        if self.graph is None:
+            return self.run(x, h, noise, *cond)
+        for static, value in zip(self.static_inputs, [x, h, noise] + list(cond)):
+            static.copy_(value)
+        self.graph.replay()
+        return self.static_output.clone()
+
+
+def compiled_sample(diff, model_forward, model_forward_uncon, h, *cond):
+    # diff.sample through a CompiledSampler, traced again when the shapes, the sampler settings or the parameter storage change.
+    # The samplers are kept on the model, keyed by the configuration they were traced for: they reference the model through
+    # its bound forwards, so a global cache would keep every model alive, while this cycle is freed with the model
+    model = model_forward.__self__
+    key = (model_forward.__name__, model_forward_uncon is None, tuple(h.shape), h.device, tuple(tuple(c.shape) for c in cond),
+           diff.timesteps, diff.sampler, diff.sample_steps, diff.eta, diff.w)
+    samplers = getattr(model, 'compiled_samplers', None)
+    if samplers is None:
+        samplers = model.compiled_samplers = {}
+    sampler = samplers.get(key)
+    if sampler is None or not sampler.matches(diff, model_forward, model_forward_uncon):
+        sampler = samplers[key] = CompiledSampler(diff, model_forward, model_forward_uncon, h, *cond)
+    return sampler.sample(h, *cond)
+
+
+def multi_sample_scores(sample, score, h, *cond, num_samples=1, aggregate='mean', chunk_size=4, rank_k=60):
+    """
+    Item scores of num_samples independent reverse chains per row of h, aggregated over the chains.
+    The chains are drawn chunk_size at a time as a single batch of chunk_size * B rows, so memory is
+    bounded by the chunk rather than by num_samples.
+    :param sample: maps a conditioning batch (h, *cond) to samples, e.g. a wrapper of diff.sample.
+    :param score: maps samples of shape (N, D) to item scores of shape (N, items).
+    :param aggregate: 'mean' averages the scores, 'rank' is reciprocal rank fusion, sum of 1 / (rank_k + rank).
+    """
+    if aggregate not in ('mean', 'rank'):
+        raise ValueError('unknown aggregate: {}'.format(aggregate))
+    batch_size = h.shape[0]
+    total = None
+    for start in range(0, num_samples, chunk_size):
+        chunk = min(chunk_size, num_samples - start)
+        x = sample(h.repeat(chunk, 1), *[c.repeat(chunk, 1) for c in cond])
+        scores = score(x)
+        if aggregate == 'rank':
+            order = scores.argsort(dim=1, descending=True)
+            ranks = torch.empty_like(order)
+            ranks.scatter_(1, order, torch.arange(scores.shape[1], device=scores.device).expand_as(order))
+            scores = 1. / (rank_k + 1 + ranks.float())
+        scores = scores.view(chunk, batch_size, -1).sum(dim=0)
+        total = scores if total is None else total + scores
+    return total / num_samples
+
+
+def blocked_topk(queries, items, k, block_size=4096, scale=None, bias=None):
+    # top-k of queries @ items.T (+ bias) computed block_size items at a time, merging the running top-k,
+    # so at most (B, k + block_size) scores exist at once; items may be stored in a lower precision,
+    # each block is converted to the dtype of queries and multiplied by its per-item scale if given
+    best_scores, best_ids = None, None
+    for start in range(0, items.shape[0], block_size):
+        scores = torch.matmul(queries, items[start:start + block_size].to(queries.dtype).transpose(0, 1))
+        if scale is not None:
+            scores = scores * scale[start:start + block_size]
+        if bias is not None:
+            scores = scores + bias[start:start + block_size]
+        scores, ids = scores.topk(min(k, scores.shape[1]), dim=1)
+        ids += start
+        if best_scores is not None:
+            scores, order = torch.cat((best_scores, scores), dim=1).topk(min(k, best_scores.shape[1] + scores.shape[1]), dim=1)
+            ids = torch.cat((best_ids, ids), dim=1).gather(1, order)
+        best_scores, best_ids = scores, ids
+    return best_scores, best_ids
+
+
+def decoder_topk(decoder, x, k, block_size=4096):
+    """
+    Top k logits of a decoder whose last layer is the nn.Linear onto the items, without the (B, items) logits:
+    the hidden layers run once and the output layer block_size items at a time, see blocked_topk.
+    The softmax usually applied to the logits is monotone and is skipped, the ranking is the same.
+    :param decoder: nn.Sequential ending in nn.Linear(hidden, item_num).
+    :param x: (B, hidden_size) decoder inputs.
+    :return: logits and ids of the top k items, sorted.
+    """
+    output = decoder[-1]
+    if not isinstance(output, nn.Linear):
+        raise ValueError('decoder_topk needs a decoder ending in nn.Linear, got {}'.format(type(output).__name__))
+    with torch.no_grad():
+        hidden = decoder[:-1](x)
+        return blocked_topk(hidden, output.weight, k, block_size, bias=output.bias)
+
+
+class SampledSoftmaxLoss(nn.Module):
+    """
+    Cross entropy of the nn.Linear onto the items computed on the target rows and a sample of negative rows only,
+    with the logQ correction (the log-probability of drawing each row is subtracted from its logit) so that the
+    sampled loss estimates the full softmax; items drawn as negatives of their own row are masked out.
+    :param counts: occurrences of every item as a training target, Q is proportional to counts + smoothing.
+    :param mode: 'sampled' draws num_negatives negatives from Q shared by the batch, 'inbatch' uses the other
+                 targets of the batch as negatives (which are drawn from Q by the data itself).
+    :param num_negatives: negatives per step of the 'sampled' mode.
+    """
+    def __init__(self, counts, mode='sampled', num_negatives=1000, smoothing=1.0):
+        super(SampledSoftmaxLoss, self).__init__()
+        if mode not in ('sampled', 'inbatch'):
+            raise ValueError('unknown sampled softmax mode: {}'.format(mode))
+        self.mode = mode
+        self.num_negatives = num_negatives
+        q = torch.as_tensor(counts, dtype=torch.float) + smoothing
+        self.register_buffer('q', q / q.sum())
+
+    def forward(self, hidden, output, target):
+        """
+        :param hidden: (B, hidden) inputs of the output layer.
+        :param output: the nn.Linear(hidden, item_num) onto the items.
+        :param target: (B, ) target items.
+        """
+        if self.mode == 'sampled':
+            negatives = torch.multinomial(self.q, self.num_negatives, replacement=True)
+            log_q = torch.log(self.q[negatives] * self.num_negatives)
+        else:
+            negatives = target
+            log_q = torch.log(self.q[negatives] * target.shape[0])
+        bias = output.bias[negatives] if output.bias is not None else 0
+        logits = torch.matmul(hidden, output.weight[negatives].transpose(0, 1)) + bias - log_q
+        accidental = torch.eq(target[:, None], negatives[None, :])
+        if self.mode == 'sampled':
+            target_logits = (hidden * output.weight[target]).sum(dim=1)
+            if output.bias is not None:
+                target_logits = target_logits + output.bias[target]
+            target_logits = target_logits - torch.log(self.q[target] * self.num_negatives)
+            logits = torch.cat((target_logits[:, None], logits.masked_fill(accidental, float('-inf'))), dim=1)
+            labels = torch.zeros_like(target)
+        else:
+            # the diagonal is the target itself, other columns holding the same item are masked
+            labels = torch.arange(target.shape[0], device=target.device)
+            accidental[labels, labels] = False
+            logits = logits.masked_fill(accidental, float('-inf'))
+        return F.cross_entropy(logits, labels)
+
+
+class ItemMatrix():
+    """
+    The item embedding table prepared for scoring and cached until its weights change (optimizer steps,
+    load_state_dict or moving the model, see weights_version); one instance is shared by predict, ItemIndex
+    and serving code.
+    :param embedding: nn.Embedding of the items.
+    :param normalize: cosine scores, the rows are normalized once per weight version and queries on every call.
+    :param dtype: storage of the prepared rows, 'fp32', 'fp16' or 'int8' with a symmetric per-row scale;
+                  scoring converts them back to the query dtype one block at a time.
+    """
+    def __init__(self, embedding, normalize=False, dtype='fp32'):
+        if dtype not in ('fp32', 'fp16', 'int8'):
+            raise ValueError('unknown item matrix dtype: {}'.format(dtype))
+        self.embedding = embedding
+        self.normalize = normalize
+        self.dtype = dtype
+        self.items = None
+        self.scale = None
+        self.version = None
+
+    def refresh(self):
+        version = weights_version(self.embedding)
+        if version == self.version:
+            return self
+        with torch.no_grad():
+            items = self.embedding.weight.detach()
+            if self.normalize:
+                items = items / items.norm(dim=-1, keepdim=True)
+            self.scale = None
+            if self.dtype == 'fp16':
+                items = items.half()
+            elif self.dtype == 'int8':
+                self.scale = items.abs().amax(dim=1).clamp_min(1e-12) / 127
+                items = torch.round(items / self.scale[:, None]).to(torch.int8)
+        self.items = items
+        self.version = version
+        return self
+
+    def dense(self):
+        # the prepared rows as a float32 matrix, the cached tensor itself in fp32
+        self.refresh()
+        if self.scale is not None:
+            return self.items.float() * self.scale[:, None]
+        return self.items.float()
+
+    def prepare(self, queries):
+        if self.normalize:
+            queries = queries / queries.norm(dim=-1, keepdim=True)
+        return queries
+
+    def score(self, queries):
+        # (B, items) scores of every item
+        self.refresh()
+        with torch.no_grad():
+            queries = self.prepare(queries)
+            scores = torch.matmul(queries, self.items.to(queries.dtype).transpose(0, 1))
+            if self.scale is not None:
+                scores = scores * self.scale
+        return scores
+
+    def topk(self, queries, k, block_size=4096):
+        # scores and ids of the top k items, without the full (B, items) score matrix
+        self.refresh()
+        with torch.no_grad():
+            return blocked_topk(self.prepare(queries), self.items, k, block_size, self.scale)
+
+
+class ItemIndex():
+    """
+    Top-k item search for generated embeddings against an ItemMatrix, rebuilt only when the matrix is.
+    :param matrix: ItemMatrix of the searchable items, it decides between dot-product and cosine scores.
+    :param mode: 'exact' scores every item in blocks (ItemMatrix.topk); 'ivf' is an approximate inverted file
+                 in NumPy: items are clustered by k-means and a query only scores the items of its nprobe
+                 closest clusters.
+    :param block_size: items scored at once in exact mode.
+    :param nlist: ivf clusters, sqrt(items) by default.
+    :param nprobe: ivf clusters searched per query.
+    :param iterations: k-means iterations of the ivf build.
+    """
+    def __init__(self, matrix, mode='exact', block_size=4096, nlist=None, nprobe=8, iterations=10, seed=0):
+        if mode not in ('exact', 'ivf'):
+            raise ValueError('unknown index mode: {}'.format(mode))
+        self.matrix = matrix
+        self.mode = mode
+        self.block_size = block_size
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.version = None
+
+    def refresh(self):
+        self.matrix.refresh()
+        if self.matrix.version == self.version:
+            return
+        if self.mode == 'ivf':
+            self.build_ivf(self.matrix.dense().cpu().numpy())
+        self.version = self.matrix.version
+
+    def build_ivf(self, items):
+        # Lloyd's k-means with inner-product assignment, items stored grouped by cluster
+        rng = np.random.RandomState(self.seed)
+        nlist = min(self.nlist or int(math.sqrt(len(items))), len(items))
+        centroids = items[rng.choice(len(items), nlist, replace=False)]
+        for _ in range(self.iterations):
+            assignment = np.argmax(items @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, items)
+            counts = np.bincount(assignment, minlength=nlist)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            if self.matrix.normalize:
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        assignment = np.argmax(items @ centroids.T, axis=1)
+        self.centroids = centroids
+        self.list_ids = np.argsort(assignment, kind='stable')
+        self.list_items = items[self.list_ids]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=nlist))))
+
+    def search(self, queries, k):
+        """
+        :param queries: tensor (B, D) of generated embeddings.
+        :return: scores and item ids of the top k items per query, tensors (B, k) on the device of queries;
+                 in ivf mode rows with fewer than k candidates are padded with -inf scores and id -1.
+        """
+        self.refresh()
+        if self.mode == 'exact':
+            return self.matrix.topk(queries, k, self.block_size)
+        with torch.no_grad():
+            return self.search_ivf(self.matrix.prepare(queries), k)
+
+    def search_ivf(self, queries, k):
+        x = queries.float().cpu().numpy()
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(x @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        scores = np.full((len(x), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(x), k), -1, dtype=np.int64)
+        for row, lists in enumerate(probes):
+            candidates = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in lists])
+            candidate_scores = self.list_items[candidates] @ x[row]
+            top = min(k, len(candidates))
+            if top == 0:
+                continue
+            best = np.argpartition(-candidate_scores, top - 1)[:top]
+            best = best[np.argsort(-candidate_scores[best], kind='stable')]
+            scores[row, :top] = candidate_scores[best]
+            ids[row, :top] = self.list_ids[candidates[best]]
+        return torch.from_numpy(scores).to(queries.device), torch.from_numpy(ids).to(queries.device)
+
+
 def pad_history(itemlist,length,pad_item):
     if len(itemlist)>=length:
         return itemlist[-length:]
@@ -94,6 +675,26 @@ def calculate_hit(sorted_list,topk,true_items,hit_purchase,ndcg_purchase):
                 ndcg_purchase[i] += 1.0 / np.log2(rank + 1)
 
 
+def calculate_hit_tensor(topk_items, topk, true_items, hit_purchase, ndcg_purchase):
+    """
+    Vectorized calculate_hit: the rank of every target is found with one comparison against the top items,
+    on the device of topk_items, and plain floats are accumulated into hit_purchase and ndcg_purchase.
+    :param topk_items: (B, >= max(topk)) item ids sorted from best to worst, e.g. scores.topk(max(topk)).indices.
+    :param topk: list of cutoffs K.
+    :param true_items: (B,) target ids, a tensor, numpy array or list.
+    """
+    true_items = torch.as_tensor(true_items, device=topk_items.device).view(-1, 1)
+    matches = torch.eq(topk_items[:, :max(topk)], true_items)
+    found = matches.any(dim=1)
+    rank = matches.float().argmax(dim=1)
+    cutoffs = torch.tensor(topk, device=topk_items.device).view(-1, 1)
+    hits = (found & (rank < cutoffs)).float()
+    ndcgs = hits / torch.log2(rank.float() + 2)
+    for i, (hit, ndcg) in enumerate(zip(hits.sum(dim=1).tolist(), ndcgs.sum(dim=1).tolist())):
+        hit_purchase[i] += hit
+        ndcg_purchase[i] += ndcg
+
+
 
 
 # class Memory():